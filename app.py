@@ -1,33 +1,167 @@
 # app.py - AI Research Chatbot with PostgreSQL support
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 import os
+import html
 import uuid
-import requests
+import time
+import json
+import hashlib
+import asyncio
+import multiprocessing
+import httpx
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from database import (
-    init_db, create_user, get_user_by_email, get_user_by_google_id,
-    add_chat_message, get_chat_history, add_uploaded_pdf, get_user_pdfs,
-    get_pdf_by_id, delete_pdf, clear_chat_history
+    init_db, close_db, create_user, get_user_by_email, get_user_by_google_id,
+    add_chat_messages, get_chat_history, add_uploaded_pdfs, get_user_pdfs,
+    get_pdf_by_id, get_pdf_texts, delete_pdf, clear_chat_and_pdfs,
+    get_llm_cache, set_llm_cache, prune_llm_cache, flush_chat_messages
 )
+from cache import init_cache, close_cache, cache_get, cache_set, cache_delete, cache_incr
 from paper_search import search_papers_from_pdf
-from ingest import ingest_pdf_to_text
-from retrieval import retrieve_from_pdf_texts
-from llm_agent import answer_with_context
+from ingest import ingest_pdf_bytes
+from retrieval import retrieve_from_pdf_texts, index_pdf_chunks, warm_up_bm25
+from llm_agent import answer_with_context_stream, build_answer_prompt, summarize_document, MODEL as LLM_MODEL
+from semantic_cache import embed_question, semantic_lookup, semantic_store, semantic_forget
 
 load_dotenv()
 
 PORT = int(os.getenv("PORT", 10000))
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", "http://localhost:10000")
+HISTORY_PAGE_SIZE = 50  # messages rendered per page / per scroll-back fetch
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers keep stylesheets for a day"""
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
 
 app = FastAPI(title="AI Research Chatbot")
+app.add_middleware(GZipMiddleware, minimum_size=500)
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+# === HTTP CLIENT & INGEST POOL ===
+http_client: httpx.AsyncClient = None  # shared client, created on startup
+ingest_pool: ProcessPoolExecutor = None  # PDF parsing runs off the event loop
+UPLOAD_CONCURRENCY = 4  # PDFs parsed at once per upload request
 
-# Initialize database
-init_db()
+@app.on_event("startup")
+async def startup():
+    global http_client, ingest_pool
+    # Keep idle connections to Google's OAuth endpoints open so logins reuse TLS sessions
+    http_client = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60)
+    )
+    # Spawn (not fork) workers so children don't inherit the event loop or DB pool sockets
+    ingest_pool = ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+    await init_cache()
+    await init_db(on_chat_flushed=bump_page_versions)
+    await prune_llm_cache(ANSWER_TTL, "llm:")
+    await prune_llm_cache(SUMMARY_TTL, "sum:")
+    await asyncio.to_thread(warm_up_bm25)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
+    ingest_pool.shutdown(wait=False, cancel_futures=True)
+    await close_db()  # its last flush still bumps page versions in the cache
+    await close_cache()
 
 # === SESSION STORAGE ===
-sessions = {}  # session_id -> user_data
+SESSION_TTL = 86400  # 1 day
+
+# Sessions live only in the shared cache: a per-worker copy would outlive a
+# logout or a finished registration handled by another worker
+async def save_session(sid: str, data: dict):
+    await cache_set(f"sess:{sid}", json.dumps(data, default=str), ex=SESSION_TTL)
+
+async def load_session(sid: str):
+    if not sid:
+        return None
+    raw = await cache_get(f"sess:{sid}")
+    return json.loads(raw) if raw else None
+
+async def delete_session(sid: str):
+    await cache_delete(f"sess:{sid}")
+
+# === ANSWER CACHE ===
+ANSWER_TTL = 14400  # 4 hours
+
+async def get_pdf_version(user_id: int) -> str:
+    """Per-user counter bumped whenever the user's PDF set changes"""
+    return await cache_get(f"pdfver:{user_id}") or "0"
+
+async def bump_pdf_version(user_id: int):
+    await cache_incr(f"pdfver:{user_id}")
+    semantic_forget(user_id)  # other workers replace theirs at the next store
+    await bump_page_version(user_id)
+
+def answer_scope(pdfs: list, pdf_version: str) -> str:
+    """Identifies the exact PDF set an answer was generated from"""
+    pdf_ids = ",".join(str(p['id']) for p in sorted(pdfs, key=lambda x: x['id']))
+    return f"{pdf_ids}|{pdf_version}"
+
+def answer_cache_key(message: str, pdfs: list, pdf_version: str) -> str:
+    raw = f"{message.strip().lower()}|{answer_scope(pdfs, pdf_version)}"
+    return "ans:" + hashlib.sha256(raw.encode()).hexdigest()
+
+def llm_cache_key(message: str, chunks: list) -> str:
+    """Key on exactly what the LLM sees, source filenames and pages included"""
+    raw = f"{LLM_MODEL}|{build_answer_prompt(message, chunks)}"
+    return "llm:" + hashlib.sha256(raw.encode()).hexdigest()
+
+# === SUMMARY CACHE ===
+SUMMARY_TTL = 30 * 86400  # 30 days; a document's summary doesn't go stale
+
+async def get_pdf_summary(pdf_text: str, pdf_name: str) -> str:
+    """Summary of a PDF, from the database cache so re-uploads skip the LLM"""
+    key = "sum:" + hashlib.sha256(f"{LLM_MODEL}|{pdf_text}".encode()).hexdigest()
+    summary = await get_llm_cache(key, SUMMARY_TTL)
+    if summary is not None:
+        print(f"✅ Cached summary for {pdf_name}")
+        return summary
+    
+    print(f"🔄 Generating summary...")
+    try:
+        summary = await asyncio.to_thread(summarize_document, pdf_text)
+    except Exception as e:
+        print(f"❌ Error generating summary: {e}")
+        return f"Document: {pdf_name}. {pdf_text[:300]}..."
+    print(f"✅ Summary: {summary[:100]}...")
+    await set_llm_cache(key, summary)
+    return summary
+
+# === CHAT PAGE ETAG ===
+# Process start marker, so a redeploy with new templates never answers 304
+_BOOT_ID = uuid.uuid4().hex
+
+async def get_page_version(user_id: int) -> str:
+    """Per-user stamp changed on every write that affects the /chat page"""
+    version = await cache_get(f"uver:{user_id}")
+    if version is None:
+        # A fresh stamp (not "0") so an evicted key can't repeat an old ETag
+        version = str(time.time_ns())
+        await cache_set(f"uver:{user_id}", version)
+    return version
+
+async def bump_page_version(user_id: int):
+    await cache_set(f"uver:{user_id}", str(time.time_ns()))
+
+async def bump_page_versions(user_ids):
+    """Called by the database once queued chat messages are committed, never before"""
+    await asyncio.gather(*[bump_page_version(user_id) for user_id in user_ids])
+
+async def chat_page_etag(user_id: int) -> str:
+    version = await get_page_version(user_id)
+    return 'W/"' + hashlib.sha1(f"{user_id}:{version}:{_BOOT_ID}".encode()).hexdigest() + '"'
 
 # === GOOGLE OAUTH ===
 def get_google_login_url():
@@ -43,7 +177,7 @@ def get_google_login_url():
     query = "&".join(f"{k}={v}" for k, v in params.items())
     return f"{base_url}?{query}"
 
-def verify_google_token(code: str):
+async def verify_google_token(code: str):
     try:
         token_url = "https://oauth2.googleapis.com/token"
         data = {
@@ -53,22 +187,25 @@ def verify_google_token(code: str):
             "grant_type": "authorization_code",
             "redirect_uri": f"{RENDER_EXTERNAL_URL}/callback"
         }
-        token_resp = requests.post(token_url, data=data, timeout=10)
+        token_resp = await http_client.post(token_url, data=data)
         if token_resp.status_code != 200:
             return None
         access_token = token_resp.json().get("access_token")
-        user_resp = requests.get(
+        user_resp = await http_client.get(
             "https://www.googleapis.com/oauth2/v3/userinfo",
-            headers={"Authorization": f"Bearer {access_token}"},
-            timeout=10
+            headers={"Authorization": f"Bearer {access_token}"}
         )
         return user_resp.json() if user_resp.status_code == 200 else None
-    except:
+    except httpx.HTTPError as e:
+        print(f"Error verifying Google token: {e}")
         return None
 
-def get_session_user(request: Request):
-    sid = request.cookies.get("session_id")
-    return sessions.get(sid) if sid and sid in sessions else None
+async def get_session_user(request: Request):
+    """The logged-in user, or None (also for a registration still in progress)"""
+    session = await load_session(request.cookies.get("session_id"))
+    if session is None or session.get("pending_registration"):
+        return None
+    return session
 
 # === HTML TEMPLATES ===
 def get_login_html():
@@ -77,53 +214,7 @@ def get_login_html():
 <html>
 <head>
     <title>अध्ययन - Research AI</title>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Inter', sans-serif; }
-        body {
-            background: linear-gradient(135deg, #0f0f23 0%, #1a1a2e 50%, #16213e 100%);
-            min-height: 100vh;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: #e0e0e0;
-        }
-        .login-box {
-            background: rgba(20, 20, 35, 0.9);
-            padding: 50px 60px;
-            border-radius: 24px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.5);
-            text-align: center;
-            max-width: 450px;
-            border: 1px solid rgba(100, 100, 150, 0.2);
-        }
-        h1 {
-            font-size: 36px;
-            margin-bottom: 10px;
-            background: linear-gradient(135deg, #a78bfa, #c4b5fd);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            font-weight: 700;
-        }
-        p { color: #9ca3af; margin-bottom: 30px; font-size: 15px; }
-        .login-btn {
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-            color: white;
-            padding: 14px 40px;
-            border-radius: 12px;
-            text-decoration: none;
-            display: inline-block;
-            font-weight: 600;
-            font-size: 16px;
-            transition: transform 0.2s, box-shadow 0.2s;
-            border: none;
-            cursor: pointer;
-        }
-        .login-btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 10px 30px rgba(124, 58, 237, 0.4);
-        }
-    </style>
+    <link rel="stylesheet" href="/static/login.css">
 </head>
 <body>
     <div class="login-box">
@@ -135,74 +226,18 @@ def get_login_html():
 </html>
 """
 
+# The login page is static: render it once. Vary on Cookie so a cached copy
+# isn't shown in place of the /chat redirect after signing in.
+LOGIN_HTML = get_login_html()
+LOGIN_HEADERS = {"Cache-Control": "public, max-age=3600", "Vary": "Cookie"}
+
 def get_registration_html(google_email, google_name):
     return f"""
 <!DOCTYPE html>
 <html>
 <head>
     <title>Complete Registration</title>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-        * {{ margin: 0; padding: 0; box-sizing: border-box; font-family: 'Inter', sans-serif; }}
-        body {{
-            background: linear-gradient(135deg, #0f0f23 0%, #1a1a2e 50%, #16213e 100%);
-            min-height: 100vh;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-        }}
-        .reg-box {{
-            background: rgba(20, 20, 35, 0.95);
-            padding: 40px 50px;
-            border-radius: 24px;
-            max-width: 550px;
-            width: 100%;
-            border: 1px solid rgba(100, 100, 150, 0.2);
-        }}
-        h2 {{
-            color: #a78bfa;
-            margin-bottom: 10px;
-            font-size: 28px;
-        }}
-        p {{ color: #9ca3af; margin-bottom: 25px; font-size: 14px; }}
-        label {{
-            display: block;
-            color: #d1d5db;
-            margin-bottom: 8px;
-            font-size: 14px;
-            font-weight: 500;
-        }}
-        input, textarea {{
-            width: 100%;
-            padding: 12px 16px;
-            margin-bottom: 20px;
-            background: rgba(30, 30, 45, 0.8);
-            border: 1px solid rgba(100, 100, 150, 0.3);
-            border-radius: 10px;
-            color: #e0e0e0;
-            font-size: 14px;
-        }}
-        input:focus, textarea:focus {{
-            outline: none;
-            border-color: #7c3aed;
-        }}
-        textarea {{ resize: vertical; min-height: 80px; }}
-        button {{
-            width: 100%;
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-            color: white;
-            padding: 14px;
-            border-radius: 12px;
-            border: none;
-            font-weight: 600;
-            font-size: 16px;
-            cursor: pointer;
-            transition: transform 0.2s;
-        }}
-        button:hover {{ transform: translateY(-2px); }}
-        .optional {{ color: #6b7280; font-size: 12px; }}
-    </style>
+    <link rel="stylesheet" href="/static/register.css">
 </head>
 <body>
     <div class="reg-box">
@@ -210,10 +245,10 @@ def get_registration_html(google_email, google_name):
         <p>We need a few more details to get you started</p>
         <form action="/register" method="post">
             <label>Full Name *</label>
-            <input type="text" name="name" value="{google_name}" required>
+            <input type="text" name="name" value="{html.escape(google_name)}" required>
             
             <label>Email *</label>
-            <input type="email" name="email" value="{google_email}" readonly>
+            <input type="email" name="email" value="{html.escape(google_email)}" readonly>
             
             <label>Username *</label>
             <input type="text" name="username" placeholder="Choose a unique username" required>
@@ -232,21 +267,21 @@ def get_registration_html(google_email, google_name):
 """
 
 def get_chat_html(user, chat_history, pdfs):
-    messages_html = ""
+    message_parts = []
     for msg in chat_history:
         role = msg['role']
-        content = msg['content']
+        content = html.escape(msg['content'])
         citations = msg.get('citations', '')
         
         if role == 'user':
-            messages_html += f"""
+            message_parts.append(f"""
             <div class="message user-message">
                 <div class="avatar">👤</div>
                 <div class="text">{content}</div>
             </div>
-            """
+            """)
         else:
-            messages_html += f"""
+            message_parts.append(f"""
             <div class="message ai-message">
                 <div class="avatar">🤖</div>
                 <div class="text">
@@ -254,277 +289,27 @@ def get_chat_html(user, chat_history, pdfs):
                     {f'<details class="citations"><summary>📚 View Citations & Related Papers</summary><div class="citation-content">{citations}</div></details>' if citations else ''}
                 </div>
             </div>
-            """
+            """)
+    messages_html = "".join(message_parts)
     
-    pdfs_html = ""
     if pdfs:
-        for pdf in pdfs:
-            pdfs_html += f"""
+        pdfs_html = "".join(f"""
             <div class="pdf-item">
                 <span class="pdf-icon">📄</span>
-                <span class="pdf-name">{pdf['filename']}</span>
+                <span class="pdf-name">{html.escape(pdf['filename'])}</span>
                 <span class="pdf-pages">{pdf['pages']} pages</span>
                 <button class="pdf-delete" onclick="if(confirm('Delete this PDF?')) window.location.href='/delete-pdf/{pdf['id']}'">×</button>
             </div>
-            """
+            """ for pdf in pdfs)
     else:
         pdfs_html = "<p class='no-pdfs'>No documents uploaded yet. Upload PDFs to start analyzing!</p>"
-
+    
     return f"""
 <!DOCTYPE html>
 <html>
 <head>
     <title>Research AI - Chat</title>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-        * {{ margin: 0; padding: 0; box-sizing: border-box; font-family: 'Inter', sans-serif; }}
-        body {{
-            background: #0a0a0f;
-            color: #e0e0e0;
-            display: flex;
-            height: 100vh;
-            overflow: hidden;
-        }}
-        .sidebar {{
-            width: 280px;
-            background: rgba(15, 15, 25, 0.95);
-            border-right: 1px solid rgba(100, 100, 150, 0.15);
-            display: flex;
-            flex-direction: column;
-            padding: 20px;
-        }}
-        .sidebar-header {{
-            margin-bottom: 30px;
-        }}
-        .sidebar-header h1 {{
-            font-size: 24px;
-            background: linear-gradient(135deg, #a78bfa, #c4b5fd);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            font-weight: 700;
-        }}
-        .user-info {{
-            display: flex;
-            align-items: center;
-            padding: 12px;
-            background: rgba(30, 30, 45, 0.5);
-            border-radius: 12px;
-            margin-bottom: 20px;
-            font-size: 14px;
-        }}
-        .user-avatar {{
-            width: 36px;
-            height: 36px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-right: 10px;
-            font-size: 18px;
-        }}
-        .pdfs-section {{
-            flex: 1;
-            overflow-y: auto;
-            margin-bottom: 20px;
-        }}
-        .pdfs-section h3 {{
-            font-size: 14px;
-            color: #9ca3af;
-            margin-bottom: 15px;
-            text-transform: uppercase;
-            letter-spacing: 1px;
-        }}
-        .pdf-item {{
-            background: rgba(30, 30, 45, 0.5);
-            padding: 10px;
-            border-radius: 8px;
-            margin-bottom: 8px;
-            display: flex;
-            align-items: center;
-            font-size: 13px;
-            position: relative;
-        }}
-        .pdf-item:hover {{
-            background: rgba(30, 30, 45, 0.7);
-        }}
-        .pdf-delete {{
-            position: absolute;
-            right: 8px;
-            background: rgba(239, 68, 68, 0.2);
-            color: #f87171;
-            border: 1px solid rgba(239, 68, 68, 0.3);
-            border-radius: 6px;
-            padding: 4px 8px;
-            font-size: 11px;
-            cursor: pointer;
-            opacity: 0;
-            transition: opacity 0.2s;
-        }}
-        .pdf-item:hover .pdf-delete {{
-            opacity: 1;
-        }}
-        .pdf-delete:hover {{
-            background: rgba(239, 68, 68, 0.4);
-        }}
-        .pdf-icon {{ margin-right: 8px; }}
-        .pdf-name {{ flex: 1; color: #d1d5db; }}
-        .pdf-pages {{ color: #6b7280; font-size: 11px; }}
-        .no-pdfs {{ color: #6b7280; font-size: 13px; text-align: center; padding: 20px 0; }}
-        .upload-label {{
-            cursor: pointer;
-            padding: 10px;
-            border-radius: 10px;
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-            color: white;
-            font-size: 14px;
-            font-weight: 600;
-            text-align: center;
-            display: block;
-            margin-bottom: 10px;
-            border: none;
-        }}
-        .upload-label:hover {{ opacity: 0.9; }}
-        input[type="file"] {{ display: none; }}
-        .logout-btn {{
-            background: rgba(239, 68, 68, 0.2);
-            color: #f87171;
-            padding: 8px;
-            border-radius: 8px;
-            text-align: center;
-            cursor: pointer;
-            font-size: 13px;
-            border: 1px solid rgba(239, 68, 68, 0.3);
-            width: 100%;
-            margin-top: 10px;
-        }}
-        .logout-btn:hover {{ background: rgba(239, 68, 68, 0.3); }}
-        .clear-chat-btn {{
-            background: rgba(255, 159, 64, 0.2);
-            color: #fbbf24;
-            padding: 8px;
-            border-radius: 8px;
-            text-align: center;
-            cursor: pointer;
-            font-size: 13px;
-            border: 1px solid rgba(255, 159, 64, 0.3);
-            width: 100%;
-            margin-top: 8px;
-        }}
-        .clear-chat-btn:hover {{ background: rgba(255, 159, 64, 0.3); }}
-        .main-content {{
-            flex: 1;
-            display: flex;
-            flex-direction: column;
-        }}
-        .chat-area {{
-            flex: 1;
-            overflow-y: auto;
-            padding: 40px 20px 20px 20px;
-            max-width: 900px;
-            margin: 0 auto;
-            width: 100%;
-        }}
-        .message {{
-            display: flex;
-            margin-bottom: 30px;
-            align-items: flex-start;
-        }}
-        .avatar {{
-            width: 36px;
-            height: 36px;
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-right: 12px;
-            font-size: 20px;
-            flex-shrink: 0;
-        }}
-        .user-message .avatar {{
-            background: linear-gradient(135deg, #3b82f6, #60a5fa);
-        }}
-        .ai-message .avatar {{
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-        }}
-        .text {{
-            flex: 1;
-            padding: 14px 18px;
-            border-radius: 16px;
-            line-height: 1.6;
-            font-size: 15px;
-        }}
-        .user-message .text {{
-            background: rgba(59, 130, 246, 0.15);
-            border: 1px solid rgba(59, 130, 246, 0.3);
-        }}
-        .ai-message .text {{
-            background: rgba(30, 30, 45, 0.6);
-            border: 1px solid rgba(100, 100, 150, 0.2);
-        }}
-        .citations {{
-            margin-top: 15px;
-            padding: 12px;
-            background: rgba(20, 20, 30, 0.8);
-            border-radius: 10px;
-            border-left: 3px solid #a78bfa;
-        }}
-        .citations summary {{
-            cursor: pointer;
-            color: #a78bfa;
-            font-weight: 600;
-            font-size: 14px;
-            margin-bottom: 10px;
-        }}
-        .citation-content {{
-            color: #d1d5db;
-            font-size: 13px;
-            line-height: 1.8;
-            margin-top: 10px;
-        }}
-        .input-area {{
-            border-top: 1px solid rgba(100, 100, 150, 0.15);
-            padding: 20px;
-            background: rgba(15, 15, 25, 0.95);
-            max-width: 900px;
-            margin: 0 auto;
-            width: 100%;
-        }}
-        .input-form {{
-            display: flex;
-            gap: 12px;
-            align-items: center;
-        }}
-        textarea {{
-            flex: 1;
-            padding: 14px 18px;
-            background: rgba(30, 30, 45, 0.8);
-            border: 1px solid rgba(100, 100, 150, 0.3);
-            border-radius: 16px;
-            color: #e0e0e0;
-            font-size: 15px;
-            resize: none;
-            font-family: 'Inter', sans-serif;
-        }}
-        textarea:focus {{
-            outline: none;
-            border-color: #7c3aed;
-        }}
-        .send-btn {{
-            background: linear-gradient(135deg, #7c3aed, #a78bfa);
-            color: white;
-            padding: 14px 24px;
-            border-radius: 16px;
-            border: none;
-            cursor: pointer;
-            font-weight: 600;
-            font-size: 15px;
-            white-space: nowrap;
-        }}
-        .send-btn:hover {{ opacity: 0.9; }}
-        .send-btn:disabled {{ opacity: 0.5; cursor: not-allowed; }}
-        input[type="file"] {{ display: none; }}
-    </style>
+    <link rel="stylesheet" href="/static/chat.css">
 </head>
 <body>
     <div class="sidebar">
@@ -533,10 +318,10 @@ def get_chat_html(user, chat_history, pdfs):
             <p style="font-size: 11px; color: #6b7280; margin-top: 5px;">Research AI</p>
         </div>
         <div class="user-info">
-            <div class="user-avatar">{user['name'][0].upper()}</div>
+            <div class="user-avatar">{html.escape(user['name'][:1].upper())}</div>
             <div>
-                <div style="font-weight: 600;">{user['name']}</div>
-                <div style="font-size: 12px; color: #6b7280;">@{user['username']}</div>
+                <div style="font-weight: 600;">{html.escape(user['name'])}</div>
+                <div style="font-size: 12px; color: #6b7280;">@{html.escape(user['username'])}</div>
             </div>
         </div>
         <div class="pdfs-section">
@@ -551,8 +336,8 @@ def get_chat_html(user, chat_history, pdfs):
         <button class="logout-btn" onclick="window.location.href='/logout'">Logout</button>
     </div>
     <div class="main-content">
-        <div class="chat-area" id="chatArea">
-            {messages_html if messages_html else '<div style="text-align: center; color: #6b7280; margin-top: 100px; font-size: 16px;">👋 Upload a PDF and start asking questions!</div>'}
+        <div class="chat-area" id="chatArea" data-oldest-id="{chat_history[0]['id'] if len(chat_history) >= HISTORY_PAGE_SIZE else ''}">
+            {messages_html if messages_html else '<div id="emptyChat" style="text-align: center; color: #6b7280; margin-top: 100px; font-size: 16px;">👋 Upload a PDF and start asking questions!</div>'}
         </div>
         <div class="input-area">
             <form action="/chat" method="post" class="input-form" id="chatForm">
@@ -571,8 +356,112 @@ def get_chat_html(user, chat_history, pdfs):
             this.style.height = (this.scrollHeight) + 'px';
         }});
         
-        document.getElementById('chatForm').addEventListener('submit', function() {{
-            document.getElementById('sendBtn').disabled = true;
+        function appendCitations(text, citations) {{
+            const details = document.createElement('details');
+            details.className = 'citations';
+            details.innerHTML = '<summary>📚 View Citations & Related Papers</summary><div class="citation-content"></div>';
+            details.querySelector('.citation-content').innerHTML = citations;
+            text.appendChild(details);
+        }}
+        
+        function buildMessage(role, content) {{
+            const msg = document.createElement('div');
+            msg.className = 'message ' + (role === 'user' ? 'user-message' : 'ai-message');
+            const avatar = document.createElement('div');
+            avatar.className = 'avatar';
+            avatar.textContent = role === 'user' ? '👤' : '🤖';
+            const text = document.createElement('div');
+            text.className = 'text';
+            const body = document.createElement('span');
+            body.textContent = content;
+            text.appendChild(body);
+            msg.appendChild(avatar);
+            msg.appendChild(text);
+            return msg;
+        }}
+        
+        function appendMessage(role, content) {{
+            const placeholder = document.getElementById('emptyChat');
+            if (placeholder) placeholder.remove();
+            
+            const msg = buildMessage(role, content);
+            chatArea.appendChild(msg);
+            chatArea.scrollTop = chatArea.scrollHeight;
+            return msg.querySelector('.text');
+        }}
+        
+        let loadingHistory = false;
+        chatArea.addEventListener('scroll', async function() {{
+            const before = chatArea.dataset.oldestId;
+            if (chatArea.scrollTop > 50 || !before || loadingHistory) return;
+            loadingHistory = true;
+            try {{
+                const res = await fetch('/chat/history?before=' + before);
+                if (!res.ok) return;
+                const data = await res.json();
+                const oldHeight = chatArea.scrollHeight;
+                const fragment = document.createDocumentFragment();
+                for (const m of data.messages) {{
+                    const msg = buildMessage(m.role, m.content);
+                    if (m.citations) appendCitations(msg.querySelector('.text'), m.citations);
+                    fragment.appendChild(msg);
+                }}
+                chatArea.insertBefore(fragment, chatArea.firstChild);
+                chatArea.scrollTop += chatArea.scrollHeight - oldHeight;
+                chatArea.dataset.oldestId = data.has_more ? data.messages[0].id : '';
+            }} finally {{
+                loadingHistory = false;
+            }}
+        }});
+        
+        document.getElementById('chatForm').addEventListener('submit', async function(e) {{
+            e.preventDefault();
+            const form = this;
+            const sendBtn = document.getElementById('sendBtn');
+            const message = textarea.value.trim();
+            if (!message) return;
+            
+            const formData = new FormData(form);
+            sendBtn.disabled = true;
+            appendMessage('user', message);
+            textarea.value = '';
+            textarea.style.height = 'auto';
+            const pending = appendMessage('assistant', 'Thinking...');
+            const body = pending.firstChild;
+            
+            try {{
+                const resp = await fetch('/chat', {{method: 'POST', body: formData}});
+                if (!resp.ok) throw new Error(resp.status);
+                
+                // Read the Server-Sent Events stream and render tokens as they arrive
+                const reader = resp.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let answer = '';
+                while (true) {{
+                    const {{value, done}} = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, {{stream: true}});
+                    const events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+                    for (const evt of events) {{
+                        if (!evt.startsWith('data: ')) continue;
+                        const data = JSON.parse(evt.slice(6));
+                        if (data.t) {{
+                            answer += data.t;
+                            body.textContent = answer;
+                        }}
+                        if (data.done) sendBtn.disabled = false;
+                        if (data.error) body.textContent = data.error;
+                        if (data.citations) appendCitations(pending, data.citations);
+                        chatArea.scrollTop = chatArea.scrollHeight;
+                    }}
+                }}
+            }} catch (err) {{
+                body.textContent = 'Something went wrong while sending your message. Please try again.';
+            }} finally {{
+                sendBtn.disabled = false;
+            }}
         }});
     </script>
 </body>
@@ -582,8 +471,11 @@ def get_chat_html(user, chat_history, pdfs):
 # === ROUTES ===
 @app.get("/")
 async def home(request: Request):
-    user = get_session_user(request)
-    return RedirectResponse("/chat") if user else HTMLResponse(get_login_html())
+    user = await get_session_user(request)
+    if user:
+        return RedirectResponse("/chat")
+    # A new response each time: GZipMiddleware rewrites the headers of the one it sends
+    return HTMLResponse(LOGIN_HTML, headers=LOGIN_HEADERS)
 
 @app.get("/login")
 async def login():
@@ -594,17 +486,17 @@ async def callback(request: Request, code: str = None):
     if not code:
         raise HTTPException(status_code=400, detail="No code provided")
     
-    google_user = verify_google_token(code)
+    google_user = await verify_google_token(code)
     if not google_user:
         raise HTTPException(status_code=400, detail="Invalid token")
     
     # Check if user exists
-    user = get_user_by_google_id(google_user.get('sub'))
+    user = await get_user_by_google_id(google_user.get('sub'))
     
     if not user:
         # New user - show registration form
         sid = str(uuid.uuid4())
-        sessions[sid] = {"pending_registration": True, "google_data": google_user}
+        await save_session(sid, {"pending_registration": True, "google_data": google_user})
         resp = HTMLResponse(get_registration_html(
             google_user.get('email', ''),
             google_user.get('name', '')
@@ -614,7 +506,7 @@ async def callback(request: Request, code: str = None):
     
     # Existing user - log them in
     sid = str(uuid.uuid4())
-    sessions[sid] = user
+    await save_session(sid, user)
     resp = RedirectResponse("/chat")
     resp.set_cookie(key="session_id", value=sid, httponly=True)
     return resp
@@ -629,17 +521,17 @@ async def register(
     research_interests: str = Form("")
 ):
     sid = request.cookies.get("session_id")
-    if not sid or sid not in sessions:
+    session_data = await load_session(sid)
+    if not session_data:
         raise HTTPException(status_code=401, detail="Invalid session")
     
-    session_data = sessions[sid]
     if not session_data.get("pending_registration"):
         raise HTTPException(status_code=400, detail="Not in registration flow")
     
     google_data = session_data["google_data"]
     
     # Create user
-    user = create_user(
+    user = await create_user(
         google_id=google_data.get('sub'),
         email=email,
         name=name,
@@ -652,28 +544,52 @@ async def register(
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Update session
-    sessions[sid] = user
+    await save_session(sid, user)
     return RedirectResponse("/chat", status_code=303)
 
 @app.get("/chat")
 async def chat_page(request: Request):
-    user = get_session_user(request)
+    user = await get_session_user(request)
     if not user:
         return RedirectResponse("/")
     
-    chat_history = get_chat_history(user['id'])
-    pdfs = get_user_pdfs(user['id'])
+    # Nothing changed since the browser's copy: skip the queries and the render.
+    # Commit this worker's queued messages first so their version bump is included.
+    await flush_chat_messages()
+    etag = await chat_page_etag(user['id'])
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    chat_history = await get_chat_history(user['id'], limit=HISTORY_PAGE_SIZE)
+    pdfs = await get_user_pdfs(user['id'])
     
-    return HTMLResponse(get_chat_html(user, chat_history, pdfs))
+    return HTMLResponse(get_chat_html(user, chat_history, pdfs), headers=headers)
+
+@app.get("/chat/history")
+async def chat_history_page(request: Request, before: int):
+    """Older messages for scroll-back, as JSON"""
+    user = await get_session_user(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    
+    messages = await get_chat_history(user['id'], limit=HISTORY_PAGE_SIZE, before_id=before)
+    return JSONResponse({
+        "messages": [
+            {"id": m['id'], "role": m['role'], "content": m['content'], "citations": m['citations'] or ""}
+            for m in messages
+        ],
+        "has_more": len(messages) == HISTORY_PAGE_SIZE
+    })
 
 @app.post("/upload")
 async def upload_pdfs(request: Request, files: list[UploadFile] = File(...)):
-    user = get_session_user(request)
+    user = await get_session_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Check current PDF count
-    current_pdfs = get_user_pdfs(user['id'])
+    current_pdfs = await get_user_pdfs(user['id'])
     
     # Limit to 5 total PDFs to avoid token issues
     if len(current_pdfs) + len(files) > 5:
@@ -682,94 +598,185 @@ async def upload_pdfs(request: Request, files: list[UploadFile] = File(...)):
             detail=f"Maximum 5 PDFs allowed. You have {len(current_pdfs)} PDFs. Please delete some before uploading more."
         )
     
-    for file in files:
+    # Read uploads on the event loop, then parse PDFs concurrently in the pool.
+    # The semaphore keeps one upload from occupying every worker.
+    files_bytes = [(file.filename, await file.read()) for file in files]
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    
+    async def ingest(name, data):
+        async with sem:
+            parsed = await loop.run_in_executor(ingest_pool, ingest_pdf_bytes, name, data)
+            return parsed, await get_pdf_summary(parsed[0], parsed[2])
+    
+    results = await asyncio.gather(
+        *[ingest(name, data) for name, data in files_bytes],
+        return_exceptions=True
+    )
+    
+    new_pdfs = []
+    for (filename, _), result in zip(files_bytes, results):
+        if isinstance(result, Exception):
+            print(f"Error uploading {filename}: {result}")
+            continue
+        
+        (pdf_text, pages, pdf_name, chunks, bm25_blob), summary = result
+        new_pdfs.append({
+            "filename": pdf_name,
+            "pdf_text": pdf_text,
+            "pages": pages,
+            "chunks": chunks,
+            "summary": summary,
+            "bm25_blob": bm25_blob
+        })
+    
+    if new_pdfs:
         try:
-            # Process PDF and extract text
-            pdf_text, pages, summary, pdf_name = ingest_pdf_to_text(file)
-            
             # Store in database (text stored in DB, no file storage needed!)
-            add_uploaded_pdf(
-                user_id=user['id'],
-                filename=pdf_name,
-                pdf_text=pdf_text,
-                pages=pages,
-                chunks=len(pdf_text.split('\n\n')),  # Rough chunk estimate
-                summary=summary
-            )
+            pdf_ids = await add_uploaded_pdfs(user['id'], new_pdfs)
         except Exception as e:
-            print(f"Error uploading {file.filename}: {e}")
-            continue
+            # The batch is one transaction: store the PDFs one at a time so a bad one only loses itself
+            print(f"Error uploading PDFs: {e}")
+            pdf_ids, stored = [], []
+            for pdf in new_pdfs:
+                try:
+                    pdf_ids += await add_uploaded_pdfs(user['id'], [pdf])
+                    stored.append(pdf)
+                except Exception as e:
+                    print(f"Error uploading {pdf['filename']}: {e}")
+            new_pdfs = stored
+        
+        # Batch-embed chunks for vector search
+        await asyncio.gather(*[
+            index_pdf_chunks(pdf_id, pdf['chunks'], pdf['filename'])
+            for pdf_id, pdf in zip(pdf_ids, new_pdfs)
+        ])
     
+    await bump_pdf_version(user['id'])
     return RedirectResponse("/chat", status_code=303)
 
+async def save_chat_exchange(user_id: int, message: str, response_text: str, citations: str):
+    await add_chat_messages([
+        (user_id, 'user', message, ""),
+        (user_id, 'assistant', response_text, citations)
+    ])
+
+def sse_event(data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"data: {json.dumps(data)}\n\n"
+
 @app.post("/chat")
 async def chat_message(request: Request, message: str = Form(...)):
-    user = get_session_user(request)
+    user = await get_session_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Get all user's PDFs
-    pdfs = get_user_pdfs(user['id'])
+    pdfs = await get_user_pdfs(user['id'])
     
-    if not pdfs:
-        response_text = "Please upload at least one PDF document before asking questions."
+    async def stream():
+        response_parts = []
         citations = ""
-    else:
         try:
-            # Retrieve context from PDF texts stored in database
-            chunks = retrieve_from_pdf_texts(message, pdfs)
+            if not pdfs:
+                response_parts.append("Please upload at least one PDF document before asking questions.")
+                yield sse_event({"t": response_parts[0]})
+                return
             
-            # Get answer from LLM
-            response_text = answer_with_context(message, chunks)
+            pdf_version = await get_pdf_version(user['id'])
+            cache_key = answer_cache_key(message, pdfs, pdf_version)
+            scope = answer_scope(pdfs, pdf_version)
+            cached = await cache_get(cache_key)
+            question_vector = None
+            if not cached:
+                # Fall back to an earlier answer to a near-identical question
+                try:
+                    question_vector = await embed_question(message)
+                except Exception as e:
+                    print(f"⚠️ Could not embed question for the semantic cache: {e}")
+                cached = semantic_lookup(user['id'], scope, question_vector)
+            if cached:
+                response_text, citations = json.loads(cached)
+                response_parts.append(response_text)
+                yield sse_event({"t": response_text})
+                yield sse_event({"done": True})
+            else:
+                # Retrieve context from PDF texts stored in database
+                chunks = await retrieve_from_pdf_texts(message, pdfs, query_vector=question_vector)
+                
+                # Same question over the same chunks (any user, any PDF set): reuse the answer
+                llm_key = llm_cache_key(message, chunks)
+                llm_answer = await get_llm_cache(llm_key, ANSWER_TTL)
+                if llm_answer:
+                    response_parts.append(llm_answer)
+                    yield sse_event({"t": llm_answer})
+                else:
+                    # Stream answer from LLM as it is generated
+                    async for token in answer_with_context_stream(message, chunks):
+                        response_parts.append(token)
+                        yield sse_event({"t": token})
+                    await set_llm_cache(llm_key, "".join(response_parts))
+                # The answer is complete: let the user type while citations are generated
+                yield sse_event({"done": True})
+                
+                # Extract citations and generate related papers. References come from the
+                # full text of the first 2 PDFs; the blocking LLM call runs off the event loop.
+                response_text = "".join(response_parts)
+                texts = await get_pdf_texts([pdf['id'] for pdf in pdfs[:2]])
+                pdfs_with_text = [{**pdf, "pdf_text": texts.get(pdf['id'], "")} for pdf in pdfs]
+                citations = await asyncio.to_thread(search_papers_from_pdf, pdfs_with_text, response_text)
+                answer = json.dumps([response_text, citations])
+                await cache_set(cache_key, answer, ex=ANSWER_TTL)
+                semantic_store(user['id'], scope, question_vector, answer)
             
-            # Extract citations and generate related papers
-            citations = search_papers_from_pdf(pdfs, response_text)
-            citations = marked.parse(citations);
+            if citations:
+                yield sse_event({"citations": citations})
         except Exception as e:
             print(f"❌ Error processing chat: {e}")
-            response_text = "I encountered an error while processing your question. Please try again."
+            response_parts = ["I encountered an error while processing your question. Please try again."]
             citations = ""
+            yield sse_event({"error": response_parts[0]})
+        finally:
+            # Save to chat history (shielded so it also completes if the client disconnects)
+            await asyncio.shield(save_chat_exchange(user['id'], message, "".join(response_parts), citations))
     
-    # Save to chat history
-    add_chat_message(user['id'], 'user', message)
-    add_chat_message(user['id'], 'assistant', response_text, citations)
-    
-    return RedirectResponse("/chat", status_code=303)
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/delete-pdf/{pdf_id}")
 async def delete_pdf_route(request: Request, pdf_id: int):
-    user = get_session_user(request)
+    user = await get_session_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Verify PDF belongs to user and delete it
-    pdf = get_pdf_by_id(pdf_id)
+    pdf = await get_pdf_by_id(pdf_id)
     if pdf and pdf['user_id'] == user['id']:
-        delete_pdf(pdf_id)
+        await delete_pdf(pdf_id)
+        await bump_pdf_version(user['id'])
     
     return RedirectResponse("/chat", status_code=303)
 
 @app.get("/clear-chat")
 async def clear_chat_route(request: Request):
-    user = get_session_user(request)
+    user = await get_session_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Clear all chat history and PDFs for this user
-    clear_chat_history(user['id'])
-    
-    # Delete all PDFs
-    pdfs = get_user_pdfs(user['id'])
-    for pdf in pdfs:
-        delete_pdf(pdf['id'])
+    await clear_chat_and_pdfs(user['id'])
+    await bump_pdf_version(user['id'])
     
     return RedirectResponse("/chat", status_code=303)
 
 @app.get("/logout")
 async def logout(request: Request):
     sid = request.cookies.get("session_id")
-    if sid and sid in sessions:
-        del sessions[sid]
+    if sid:
+        await delete_session(sid)
     
     resp = RedirectResponse("/")
     resp.delete_cookie("session_id")
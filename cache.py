@@ -0,0 +1,66 @@
+# cache.py - Redis cache with in-memory fallback (auto-detects)
+import os
+import time
+from typing import Optional
+from cachetools import LRUCache
+
+# Check if Redis is available (set REDIS_URL to share state across workers)
+REDIS_URL = os.getenv("REDIS_URL")
+USE_REDIS = REDIS_URL is not None
+
+if USE_REDIS:
+    import redis.asyncio as aioredis
+    print("✅ Using Redis cache")
+else:
+    print("✅ Using in-memory cache (local development)")
+
+redis = None  # redis.asyncio client, created by init_cache()
+_memory = LRUCache(maxsize=10000)  # fallback store: key -> (value, expires_at)
+
+async def init_cache():
+    """Connect to Redis (no-op for the in-memory fallback)"""
+    global redis
+    if USE_REDIS:
+        redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+
+async def close_cache():
+    """Close the Redis connection pool"""
+    if redis is not None:
+        await redis.aclose()
+
+async def cache_get(key: str) -> Optional[str]:
+    """Get a cached string value, or None if missing/expired"""
+    if USE_REDIS:
+        return await redis.get(key)
+    
+    entry = _memory.get(key)
+    if entry is None:
+        return None
+    value, expires_at = entry
+    if expires_at is not None and expires_at < time.time():
+        _memory.pop(key, None)
+        return None
+    return value
+
+async def cache_set(key: str, value: str, ex: Optional[int] = None):
+    """Set a string value with an optional TTL in seconds"""
+    if USE_REDIS:
+        await redis.set(key, value, ex=ex)
+    else:
+        _memory[key] = (value, time.time() + ex if ex else None)
+
+async def cache_delete(key: str):
+    """Delete a cached value"""
+    if USE_REDIS:
+        await redis.delete(key)
+    else:
+        _memory.pop(key, None)
+
+async def cache_incr(key: str) -> int:
+    """Atomically increment an integer counter (no TTL)"""
+    if USE_REDIS:
+        return await redis.incr(key)
+    
+    value = int((await cache_get(key)) or 0) + 1
+    _memory[key] = (str(value), None)
+    return value
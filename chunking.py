@@ -0,0 +1,138 @@
+# chunking.py - Split PDF text into chunks and build their keyword index
+# Imported by the ingest worker processes, so it depends on NumPy alone.
+import io
+import re
+import zlib
+from typing import List, Dict, Optional
+import numpy as np
+
+CHUNK_SIZE = 1000  # characters per chunk (matches the 1000-char context truncation)
+CHUNK_OVERLAP = 150  # ~15% overlap between consecutive chunks
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def extract_chunks_from_text(pdf_text: str, filename: str) -> List[Dict]:
+    """
+    Split PDF text into chunks by pages.
+    """
+    chunks = []
+    pdf_text = pdf_text.replace('\x00', '')
+    # Split by page markers
+    pages = pdf_text.split("--- Page ")
+    
+    for page_text in pages:
+        if not page_text.strip():
+            continue
+        
+        # Extract page number
+        try:
+            page_num_end = page_text.find(" ---")
+            if page_num_end > 0:
+                page_num = page_text[:page_num_end].strip()
+                text = page_text[page_num_end + 4:].strip()
+            else:
+                page_num = "1"
+                text = page_text.strip()
+        except:
+            page_num = "?"
+            text = page_text.strip()
+        
+        if text:
+            chunks.append({
+                "text": text,
+                "page": page_num,
+                "source": filename
+            })
+    
+    return chunks
+
+def split_into_chunks(pdf_text: str, filename: str, size: int = CHUNK_SIZE,
+                      overlap: int = CHUNK_OVERLAP) -> List[Dict]:
+    """
+    Split PDF text into overlapping fixed-size chunks, keeping page numbers.
+    """
+    chunks = []
+    for page in extract_chunks_from_text(pdf_text, filename):
+        text = page['text']
+        start = 0
+        while start < len(text):
+            end = min(start + size, len(text))
+            if end < len(text):
+                # Break on whitespace so words aren't cut in half
+                space = text.rfind(' ', start + size // 2, end)
+                if space > 0:
+                    end = space
+            
+            chunk_text = text[start:end].strip()
+            if chunk_text:
+                chunks.append({
+                    "text": chunk_text,
+                    "page": page['page'],
+                    "source": filename
+                })
+            
+            if end >= len(text):
+                break
+            start = max(end - overlap, start + 1)
+    
+    return chunks
+
+def tokenize(text: str) -> np.ndarray:
+    """
+    Lowercase and split text into hashed int32 token IDs.
+    Hashing keeps IDs comparable across PDFs without a shared vocabulary.
+    """
+    return np.array(
+        [zlib.crc32(tok.encode()) & 0x7FFFFFFF for tok in _TOKEN_RE.findall(text.lower())],
+        dtype=np.int32
+    )
+
+def build_bm25_index(chunks: List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    Build an inverted index over a PDF's chunks.
+    Term vocab[t] occurs in chunks post_docs[post_offsets[t]:post_offsets[t + 1]]
+    with frequencies post_tf[...]; doc_lens holds each chunk's token count.
+    """
+    doc_lens = np.zeros(len(chunks), dtype=np.int32)
+    term_lists, doc_lists, tf_lists = [], [], []
+    for d, chunk in enumerate(chunks):
+        tokens = tokenize(chunk['text'])
+        doc_lens[d] = len(tokens)
+        terms, counts = np.unique(tokens, return_counts=True)
+        term_lists.append(terms)
+        doc_lists.append(np.full(len(terms), d, dtype=np.int32))
+        tf_lists.append(counts.astype(np.float32))
+    
+    if not term_lists:
+        return {
+            "vocab": np.zeros(0, dtype=np.int32),
+            "post_offsets": np.zeros(1, dtype=np.int64),
+            "post_docs": np.zeros(0, dtype=np.int32),
+            "post_tf": np.zeros(0, dtype=np.float32),
+            "doc_lens": doc_lens
+        }
+    
+    # Group postings by term; the stable sort keeps them in chunk order
+    terms = np.concatenate(term_lists)
+    order = np.argsort(terms, kind='stable')
+    vocab, starts = np.unique(terms[order], return_index=True)
+    return {
+        "vocab": vocab,
+        "post_offsets": np.append(starts, len(terms)).astype(np.int64),
+        "post_docs": np.concatenate(doc_lists)[order],
+        "post_tf": np.concatenate(tf_lists)[order],
+        "doc_lens": doc_lens
+    }
+
+def build_bm25_blob(chunks: List[Dict]) -> bytes:
+    """Build the keyword index for a PDF's chunks at upload time, serialized for the DB"""
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **build_bm25_index(chunks))
+    return buf.getvalue()
+
+def load_bm25_blob(blob: Optional[bytes]) -> Optional[Dict[str, np.ndarray]]:
+    """Deserialize a stored keyword index (None for PDFs uploaded without one)"""
+    if not blob:
+        return None
+    with np.load(io.BytesIO(blob)) as data:
+        return {name: data[name] for name in data.files}
@@ -1,353 +1,858 @@
 # database.py - PostgreSQL + SQLite support (auto-detects)
 import os
+import glob
+import json
+import asyncio
+import threading
+from collections import deque
 from typing import Optional, List, Dict
 from datetime import datetime
+from contextlib import asynccontextmanager
+
+try:
+    import msvcrt  # Windows file locks
+except ImportError:
+    msvcrt = None
+    import fcntl
 
 # Check if PostgreSQL is available (Render sets DATABASE_URL)
 DATABASE_URL = os.getenv("DATABASE_URL")
 USE_POSTGRES = DATABASE_URL is not None
 
 if USE_POSTGRES:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import asyncpg
     print("✅ Using PostgreSQL database")
+    # Errors caused by the row itself, which no retry can fix
+    ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, ValueError, TypeError)
 else:
     import sqlite3
+    import aiosqlite
     print("✅ Using SQLite database (local development)")
+    ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.InterfaceError,
+                  sqlite3.ProgrammingError, ValueError, TypeError)
 
 DB_PATH = "research_ai.db"  # SQLite fallback
+CHAT_JOURNAL = f"chat_journal.{os.getpid()}.jsonl"  # unflushed chat messages of this process
+CHAT_JOURNAL_LOCK = f"chat_journal.{os.getpid()}.lock"  # held while this process is alive
+CHAT_FLUSH_INTERVAL = 0.5  # seconds between batched chat history writes
+EMBEDDING_DIM = 768  # must match llm_agent.EMBEDDING_MODEL
+# asyncpg prepares each query once per pooled connection and reuses the plan;
+# set to 0 behind a transaction-mode pgbouncer, which can't keep them
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+
+# Indexes for the per-user lookups behind every page load. users.google_id
+# and users.email are already indexed by their UNIQUE constraints.
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_pdfs_user_uploaded ON uploaded_pdfs(user_id, uploaded_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_user_id_desc ON chat_history(user_id, id DESC)",
+]
+# Copies legacy uploaded_pdfs.pdf_text values into uploaded_pdf_texts
+MOVE_PDF_TEXTS = """
+    INSERT INTO uploaded_pdf_texts (pdf_id, pdf_text)
+    SELECT id, pdf_text FROM uploaded_pdfs
+    WHERE pdf_text IS NOT NULL AND id NOT IN (SELECT pdf_id FROM uploaded_pdf_texts)
+"""
+USE_PGVECTOR = False  # set by init_db() once the pgvector extension is available
 
-def get_db():
-    """Get database connection (PostgreSQL or SQLite)"""
+pool = None  # asyncpg connection pool, created by init_db()
+sqlite_conn = None  # shared SQLite connection, created by init_db()
+sqlite_lock = asyncio.Lock()  # one user of the SQLite connection at a time
+
+@asynccontextmanager
+async def get_db():
+    """Get database connection (pooled PostgreSQL or shared SQLite)"""
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
+        async with pool.acquire() as conn:
+            yield conn
     else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
-
-def init_db():
-    """Initialize database with tables"""
-    conn = get_db()
-    cursor = conn.cursor()
+        async with sqlite_lock:
+            try:
+                yield sqlite_conn
+            except BaseException:
+                # Don't leave half-done writes for the next caller's commit
+                await sqlite_conn.rollback()
+                raise
+
+async def init_db(on_chat_flushed=None):
+    """
+    Create the connection pool and initialize database with tables.
+    on_chat_flushed(user_ids) is awaited after each batch of chat messages is written.
+    """
+    global pool, sqlite_conn, USE_PGVECTOR, _flush_task, _on_chat_flushed
+    _on_chat_flushed = on_chat_flushed
     
     if USE_POSTGRES:
-        # PostgreSQL syntax
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                google_id TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                username TEXT UNIQUE NOT NULL,
-                organization TEXT NOT NULL,
-                research_interests TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                citations TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS uploaded_pdfs (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                filename TEXT NOT NULL,
-                pdf_text TEXT,
-                pages INTEGER NOT NULL,
-                chunks INTEGER NOT NULL,
-                summary TEXT,
-                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=5,
+            max_size=20,
+            command_timeout=30,
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=PG_STATEMENT_CACHE_SIZE
+        )
     else:
-        # SQLite syntax
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                google_id TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                username TEXT UNIQUE NOT NULL,
-                organization TEXT NOT NULL,
-                research_interests TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                citations TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS uploaded_pdfs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                filename TEXT NOT NULL,
-                pdf_text TEXT,
-                pages INTEGER NOT NULL,
-                chunks INTEGER NOT NULL,
-                summary TEXT,
-                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
+        sqlite_conn = await aiosqlite.connect(DB_PATH)
+        sqlite_conn.row_factory = aiosqlite.Row
+        await sqlite_conn.execute("PRAGMA journal_mode=WAL")
+        await sqlite_conn.execute("PRAGMA synchronous=NORMAL")
+    
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            # PostgreSQL syntax
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id SERIAL PRIMARY KEY,
+                    google_id TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    name TEXT NOT NULL,
+                    username TEXT UNIQUE NOT NULL,
+                    organization TEXT NOT NULL,
+                    research_interests TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    id SERIAL PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    citations TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_pdfs (
+                    id SERIAL PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    pages INTEGER NOT NULL,
+                    chunks INTEGER NOT NULL,
+                    summary TEXT,
+                    bm25_blob BYTEA,
+                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            await conn.execute("ALTER TABLE uploaded_pdfs ADD COLUMN IF NOT EXISTS bm25_blob BYTEA")
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_pdf_texts (
+                    pdf_id INTEGER PRIMARY KEY,
+                    pdf_text TEXT NOT NULL,
+                    FOREIGN KEY (pdf_id) REFERENCES uploaded_pdfs(id) ON DELETE CASCADE
+                )
+            """)
+            
+            # Older databases kept the full text in uploaded_pdfs: move it out
+            has_text_column = await conn.fetchval("""
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'uploaded_pdfs' AND column_name = 'pdf_text'
+                )
+            """)
+            if has_text_column:
+                async with conn.transaction():
+                    await conn.execute(MOVE_PDF_TEXTS)
+                    await conn.execute("ALTER TABLE uploaded_pdfs DROP COLUMN pdf_text")
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pdf_chunks (
+                    pdf_id INTEGER NOT NULL,
+                    idx INTEGER NOT NULL,
+                    page TEXT,
+                    chunk_text TEXT NOT NULL,
+                    PRIMARY KEY (pdf_id, idx),
+                    FOREIGN KEY (pdf_id) REFERENCES uploaded_pdfs(id) ON DELETE CASCADE
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            for statement in INDEXES:
+                await conn.execute(statement)
+            
+            # Chunk embeddings for vector search (needs the pgvector extension)
+            try:
+                async with conn.transaction():
+                    await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+                    await conn.execute(f"""
+                        CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                            id SERIAL PRIMARY KEY,
+                            pdf_id INTEGER NOT NULL,
+                            page TEXT,
+                            chunk_text TEXT NOT NULL,
+                            embedding vector({EMBEDDING_DIM}) NOT NULL,
+                            FOREIGN KEY (pdf_id) REFERENCES uploaded_pdfs(id) ON DELETE CASCADE
+                        )
+                    """)
+                    # No ANN index: searches only cover one user's few PDFs, a few hundred
+                    # rows, and an exact scan via pdf_id never misses rows the way an ANN
+                    # probe followed by the pdf_id filter can
+                    await conn.execute("CREATE INDEX IF NOT EXISTS idx_chunk_embeddings_pdf ON chunk_embeddings(pdf_id)")
+                USE_PGVECTOR = True
+                print("✅ pgvector enabled")
+            except Exception as e:
+                print(f"⚠️ pgvector unavailable, using keyword search: {e}")
+        else:
+            # SQLite syntax
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    google_id TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    name TEXT NOT NULL,
+                    username TEXT UNIQUE NOT NULL,
+                    organization TEXT NOT NULL,
+                    research_interests TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    citations TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_pdfs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    pages INTEGER NOT NULL,
+                    chunks INTEGER NOT NULL,
+                    summary TEXT,
+                    bm25_blob BLOB,
+                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pdf_chunks (
+                    pdf_id INTEGER NOT NULL,
+                    idx INTEGER NOT NULL,
+                    page TEXT,
+                    chunk_text TEXT NOT NULL,
+                    PRIMARY KEY (pdf_id, idx),
+                    FOREIGN KEY (pdf_id) REFERENCES uploaded_pdfs(id) ON DELETE CASCADE
+                )
+            """)
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_pdf_texts (
+                    pdf_id INTEGER PRIMARY KEY,
+                    pdf_text TEXT NOT NULL,
+                    FOREIGN KEY (pdf_id) REFERENCES uploaded_pdfs(id) ON DELETE CASCADE
+                )
+            """)
+            
+            # Add columns introduced after the table was first created
+            cursor = await conn.execute("PRAGMA table_info(uploaded_pdfs)")
+            columns = [row['name'] for row in await cursor.fetchall()]
+            if 'bm25_blob' not in columns:
+                await conn.execute("ALTER TABLE uploaded_pdfs ADD COLUMN bm25_blob BLOB")
+            
+            # Older databases kept the full text in uploaded_pdfs: move it out
+            # (the column is emptied rather than dropped, for older SQLite versions)
+            if 'pdf_text' in columns:
+                await conn.execute(MOVE_PDF_TEXTS)
+                await conn.execute("UPDATE uploaded_pdfs SET pdf_text = NULL WHERE pdf_text IS NOT NULL")
+            
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            for statement in INDEXES:
+                await conn.execute(statement)
+            
+            await conn.commit()
+    
+    await asyncio.to_thread(_adopt_chat_journals)
+    _flush_task = asyncio.create_task(_flush_loop())
     
-    conn.commit()
-    conn.close()
     print("✅ Database initialized successfully")
 
+async def close_db():
+    """Flush queued chat messages, then close the pool (or the shared SQLite connection)"""
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await flush_chat_messages()
+    if _journal_owner is not None:
+        _release_lock(_journal_owner, CHAT_JOURNAL_LOCK)
+    if pool is not None:
+        await pool.close()
+    if sqlite_conn is not None:
+        await sqlite_conn.close()
+
 # === USER OPERATIONS ===
 
-def create_user(google_id: str, email: str, name: str, username: str, 
-                organization: str, research_interests: str = "") -> Optional[Dict]:
+async def create_user(google_id: str, email: str, name: str, username: str,
+                      organization: str, research_interests: str = "") -> Optional[Dict]:
     """Create a new user"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        if USE_POSTGRES:
-            cursor.execute("""
-                INSERT INTO users (google_id, email, name, username, organization, research_interests)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (google_id, email, name, username, organization, research_interests))
-            user_id = cursor.fetchone()['id']
-        else:
-            cursor.execute("""
-                INSERT INTO users (google_id, email, name, username, organization, research_interests)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (google_id, email, name, username, organization, research_interests))
-            user_id = cursor.lastrowid
+        async with get_db() as conn:
+            if USE_POSTGRES:
+                row = await conn.fetchrow("""
+                    INSERT INTO users (google_id, email, name, username, organization, research_interests)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    RETURNING *
+                """, google_id, email, name, username, organization, research_interests)
+            else:
+                # Re-read on the same connection (RETURNING needs SQLite 3.35+)
+                cursor = await conn.execute("""
+                    INSERT INTO users (google_id, email, name, username, organization, research_interests)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (google_id, email, name, username, organization, research_interests))
+                await conn.commit()
+                cursor = await conn.execute("SELECT * FROM users WHERE id = ?", (cursor.lastrowid,))
+                row = await cursor.fetchone()
         
-        conn.commit()
-        conn.close()
-        
-        return get_user_by_id(user_id)
+        return dict(row)
     except Exception as e:
         print(f"Error creating user: {e}")
         return None
 
-def get_user_by_id(user_id: int) -> Optional[Dict]:
+async def get_user_by_id(user_id: int) -> Optional[Dict]:
     """Get user by ID"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            row = await conn.fetchrow("SELECT * FROM users WHERE id = $1", user_id)
+        else:
+            cursor = await conn.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            row = await cursor.fetchone()
     
-    row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
-def get_user_by_email(email: str) -> Optional[Dict]:
+async def get_user_by_email(email: str) -> Optional[Dict]:
     """Get user by email"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-    else:
-        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            row = await conn.fetchrow("SELECT * FROM users WHERE email = $1", email)
+        else:
+            cursor = await conn.execute("SELECT * FROM users WHERE email = ?", (email,))
+            row = await cursor.fetchone()
     
-    row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
-def get_user_by_google_id(google_id: str) -> Optional[Dict]:
+async def get_user_by_google_id(google_id: str) -> Optional[Dict]:
     """Get user by Google ID"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("SELECT * FROM users WHERE google_id = %s", (google_id,))
-    else:
-        cursor.execute("SELECT * FROM users WHERE google_id = ?", (google_id,))
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            row = await conn.fetchrow("SELECT * FROM users WHERE google_id = $1", google_id)
+        else:
+            cursor = await conn.execute("SELECT * FROM users WHERE google_id = ?", (google_id,))
+            row = await cursor.fetchone()
     
-    row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 # === CHAT HISTORY OPERATIONS ===
 
-def add_chat_message(user_id: int, role: str, content: str, citations: str = ""):
-    """Add a chat message to history"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("""
-            INSERT INTO chat_history (user_id, role, content, citations)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, role, content, citations))
-    else:
-        cursor.execute("""
-            INSERT INTO chat_history (user_id, role, content, citations)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, role, content, citations))
-    
-    conn.commit()
-    conn.close()
+# Messages are queued in memory and written in batches by a background task.
+# Each queued row is also appended (fsynced) to a per-process journal. The
+# process holds an OS lock on a matching .lock file for its lifetime, so a
+# worker starting up can tell an orphaned journal (lock free) from a live
+# one and take over its rows. PIDs alone can't tell: they get reused.
+_pending_messages = deque()
+_journal_lock = threading.Lock()
+_flush_lock = asyncio.Lock()
+_flush_task = None
+_journal_owner = None  # open, locked CHAT_JOURNAL_LOCK
+_on_chat_flushed = None  # async callback(user_ids), run once their messages are committed
+
+def _try_lock(path: str):
+    """Open and exclusively lock path without blocking; None if another process holds it"""
+    f = open(path, "a+")
+    try:
+        if msvcrt is not None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def _release_lock(f, path: str):
+    if msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    f.close()
+    os.remove(path)
+
+def _journal_append(*rows: tuple):
+    with _journal_lock:
+        with open(CHAT_JOURNAL, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+        _pending_messages.extend(rows)
+
+def _journal_rewrite():
+    """Shrink the journal to the rows that are still queued"""
+    with _journal_lock:
+        rows = list(_pending_messages)
+        if not rows:
+            if os.path.exists(CHAT_JOURNAL):
+                os.remove(CHAT_JOURNAL)
+            return
+        tmp_path = CHAT_JOURNAL + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, CHAT_JOURNAL)
+
+async def _insert_chat_messages(rows: List[tuple]):
+    """Write (user_id, role, content, citations) rows in one transaction"""
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            async with conn.transaction():
+                await conn.executemany("""
+                    INSERT INTO chat_history (user_id, role, content, citations)
+                    VALUES ($1, $2, $3, $4)
+                """, rows)
+        else:
+            await conn.executemany("""
+                INSERT INTO chat_history (user_id, role, content, citations)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+            await conn.commit()
 
-def get_chat_history(user_id: int, limit: int = 50) -> List[Dict]:
-    """Get chat history for a user"""
-    conn = get_db()
-    cursor = conn.cursor()
+async def flush_chat_messages():
+    """Write all queued chat messages to the database"""
+    async with _flush_lock:
+        rows = list(_pending_messages)
+        if not rows:
+            return
+        written = set()
+        try:
+            await _insert_chat_messages(rows)
+            written.update(row[0] for row in rows)
+        except ROW_ERRORS:
+            # One bad row fails the whole batch: write the rows one at a time instead
+            for row in rows:
+                try:
+                    await _insert_chat_messages([row])
+                    written.add(row[0])
+                except ROW_ERRORS as e:
+                    # Dropped so it stops blocking the queue; log enough to find it
+                    print(f"❌ Dropped chat message {row!r:.300}: {e}")
+                _pending_messages.popleft()
+        else:
+            for _ in rows:
+                _pending_messages.popleft()
+        await asyncio.to_thread(_journal_rewrite)
+        
+        if written and _on_chat_flushed is not None:
+            try:
+                await _on_chat_flushed(written)
+            except Exception as e:
+                print(f"❌ Error after flushing chat messages: {e}")
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(CHAT_FLUSH_INTERVAL)
+        try:
+            await flush_chat_messages()
+        except Exception as e:
+            print(f"❌ Error flushing chat messages: {e}")
+
+def _read_journal(path: str) -> List[tuple]:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = tuple(json.loads(line))
+            except (ValueError, TypeError):
+                continue  # blank, or cut short by a crash mid-write
+            if len(row) == 4:
+                rows.append(row)
+    return rows
+
+def _adopt_chat_journals():
+    """Queue the messages of workers that exited before flushing them"""
+    global _journal_owner
+    _journal_owner = _try_lock(CHAT_JOURNAL_LOCK)
     
-    if USE_POSTGRES:
-        cursor.execute("""
-            SELECT role, content, citations, timestamp
-            FROM chat_history
-            WHERE user_id = %s
-            ORDER BY timestamp ASC
-            LIMIT %s
-        """, (user_id, limit))
-    else:
-        cursor.execute("""
-            SELECT role, content, citations, timestamp
-            FROM chat_history
-            WHERE user_id = ?
-            ORDER BY timestamp ASC
-            LIMIT ?
-        """, (user_id, limit))
+    # Our own journal is left over from an earlier process with the same PID
+    if os.path.exists(CHAT_JOURNAL):
+        _pending_messages.extend(_read_journal(CHAT_JOURNAL))
     
-    rows = cursor.fetchall()
-    conn.close()
+    names = {os.path.splitext(p)[0] for p in glob.glob("chat_journal.*.jsonl") + glob.glob("chat_journal.*.lock")}
+    for name in names:
+        path, lock_path = name + ".jsonl", name + ".lock"
+        if path == CHAT_JOURNAL:
+            continue
+        try:
+            lock = _try_lock(lock_path)
+            if lock is None:
+                continue  # another live worker's queue
+            try:
+                if os.path.exists(path):
+                    rows = _read_journal(path)
+                    if rows:
+                        _journal_append(*rows)
+                        print(f"✅ Recovered {len(rows)} chat messages from {path}")
+                    os.remove(path)
+            finally:
+                _release_lock(lock, lock_path)
+        except OSError as e:
+            print(f"❌ Error recovering chat messages from {path}: {e}")
+
+async def add_chat_message(user_id: int, role: str, content: str, citations: str = ""):
+    """Queue a chat message for the next batch write"""
+    await add_chat_messages([(user_id, role, content, citations)])
+
+async def add_chat_messages(messages: List[tuple]):
+    """Queue (user_id, role, content, citations) messages together: one journal fsync,
+    and always flushed in the same batch"""
+    rows = [(user_id, role, _clean_text(content), _clean_text(citations))
+            for user_id, role, content, citations in messages]
+    await asyncio.to_thread(_journal_append, *rows)
+
+def _clean_text(text: str) -> str:
+    """Drop what a TEXT column can't store: NUL characters and unpaired surrogates"""
+    text = (text or "").replace("\x00", "")
+    return text.encode("utf-8", "replace").decode("utf-8")
+
+async def get_chat_history(user_id: int, limit: int = 50,
+                           before_id: Optional[int] = None) -> List[Dict]:
+    """Get the latest `limit` messages for a user (older than before_id), oldest first"""
+    await flush_chat_messages()
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            rows = await conn.fetch("""
+                SELECT id, role, content, citations, timestamp
+                FROM chat_history
+                WHERE user_id = $1 AND ($3::int IS NULL OR id < $3)
+                ORDER BY id DESC
+                LIMIT $2
+            """, user_id, limit, before_id)
+        else:
+            cursor = await conn.execute("""
+                SELECT id, role, content, citations, timestamp
+                FROM chat_history
+                WHERE user_id = ? AND (? IS NULL OR id < ?)
+                ORDER BY id DESC
+                LIMIT ?
+            """, (user_id, before_id, before_id, limit))
+            rows = await cursor.fetchall()
     
-    return [dict(row) for row in rows]
+    return [dict(row) for row in reversed(rows)]
 
-def clear_chat_history(user_id: int):
+async def clear_chat_history(user_id: int):
     """Clear all chat history for a user"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("DELETE FROM chat_history WHERE user_id = %s", (user_id,))
-    else:
-        cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-    
-    conn.commit()
-    conn.close()
+    await flush_chat_messages()
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            await conn.execute("DELETE FROM chat_history WHERE user_id = $1", user_id)
+        else:
+            await conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            await conn.commit()
 
 # === PDF OPERATIONS ===
 
-def add_uploaded_pdf(user_id: int, filename: str, pdf_text: str, 
-                     pages: int, chunks: int, summary: str = ""):
-    """Add an uploaded PDF to the database (stores text in DB)"""
-    conn = get_db()
-    cursor = conn.cursor()
+async def add_uploaded_pdfs(user_id: int, pdfs: List[Dict]) -> List[int]:
+    """
+    Add uploaded PDFs and their retrieval chunks in one transaction. Returns their IDs.
+    Each PDF dict has filename, pdf_text, pages, chunks, summary and bm25_blob.
+    """
+    pdf_ids = []
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            async with conn.transaction():
+                for pdf in pdfs:
+                    pdf_ids.append(await conn.fetchval("""
+                        INSERT INTO uploaded_pdfs (user_id, filename, pages, chunks, summary, bm25_blob)
+                        VALUES ($1, $2, $3, $4, $5, $6)
+                        RETURNING id
+                    """, user_id, pdf['filename'], pdf['pages'], len(pdf['chunks']),
+                        pdf['summary'], pdf['bm25_blob']))
+                await conn.executemany("""
+                    INSERT INTO uploaded_pdf_texts (pdf_id, pdf_text) VALUES ($1, $2)
+                """, [(pdf_id, pdf['pdf_text']) for pdf_id, pdf in zip(pdf_ids, pdfs)])
+                await conn.executemany("""
+                    INSERT INTO pdf_chunks (pdf_id, idx, page, chunk_text)
+                    VALUES ($1, $2, $3, $4)
+                """, _chunk_rows(pdf_ids, pdfs))
+        else:
+            for pdf in pdfs:
+                cursor = await conn.execute("""
+                    INSERT INTO uploaded_pdfs (user_id, filename, pages, chunks, summary, bm25_blob)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (user_id, pdf['filename'], pdf['pages'], len(pdf['chunks']),
+                      pdf['summary'], pdf['bm25_blob']))
+                pdf_ids.append(cursor.lastrowid)
+            await conn.executemany("""
+                INSERT INTO uploaded_pdf_texts (pdf_id, pdf_text) VALUES (?, ?)
+            """, [(pdf_id, pdf['pdf_text']) for pdf_id, pdf in zip(pdf_ids, pdfs)])
+            await conn.executemany("""
+                INSERT INTO pdf_chunks (pdf_id, idx, page, chunk_text)
+                VALUES (?, ?, ?, ?)
+            """, _chunk_rows(pdf_ids, pdfs))
+            await conn.commit()
     
-    if USE_POSTGRES:
-        cursor.execute("""
-            INSERT INTO uploaded_pdfs (user_id, filename, pdf_text, pages, chunks, summary)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_id, filename, pdf_text, pages, chunks, summary))
-    else:
-        cursor.execute("""
-            INSERT INTO uploaded_pdfs (user_id, filename, pdf_text, pages, chunks, summary)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, filename, pdf_text, pages, chunks, summary))
+    return pdf_ids
+
+def _chunk_rows(pdf_ids: List[int], pdfs: List[Dict]) -> List[tuple]:
+    """(pdf_id, idx, page, chunk_text) rows for every chunk of the given PDFs"""
+    return [
+        (pdf_id, i, chunk['page'], chunk['text'])
+        for pdf_id, pdf in zip(pdf_ids, pdfs)
+        for i, chunk in enumerate(pdf['chunks'])
+    ]
+
+async def get_user_pdfs(user_id: int) -> List[Dict]:
+    """Get all PDFs uploaded by a user (metadata only: no text or keyword index)"""
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            rows = await conn.fetch("""
+                SELECT id, filename, pages, chunks, summary, uploaded_at
+                FROM uploaded_pdfs
+                WHERE user_id = $1
+                ORDER BY uploaded_at DESC
+            """, user_id)
+        else:
+            cursor = await conn.execute("""
+                SELECT id, filename, pages, chunks, summary, uploaded_at
+                FROM uploaded_pdfs
+                WHERE user_id = ?
+                ORDER BY uploaded_at DESC
+            """, (user_id,))
+            rows = await cursor.fetchall()
     
-    conn.commit()
-    conn.close()
+    return [dict(row) for row in rows]
 
-def get_user_pdfs(user_id: int) -> List[Dict]:
-    """Get all PDFs uploaded by a user"""
-    conn = get_db()
-    cursor = conn.cursor()
+async def get_pdf_texts(pdf_ids: List[int]) -> Dict[int, str]:
+    """Get the full extracted text of the given PDFs, keyed by PDF ID"""
+    if not pdf_ids:
+        return {}
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            rows = await conn.fetch("""
+                SELECT pdf_id, pdf_text FROM uploaded_pdf_texts WHERE pdf_id = ANY($1::int[])
+            """, pdf_ids)
+        else:
+            placeholders = ", ".join("?" * len(pdf_ids))
+            cursor = await conn.execute(f"""
+                SELECT pdf_id, pdf_text FROM uploaded_pdf_texts WHERE pdf_id IN ({placeholders})
+            """, pdf_ids)
+            rows = await cursor.fetchall()
     
-    if USE_POSTGRES:
-        cursor.execute("""
-            SELECT id, filename, pdf_text, pages, chunks, summary, uploaded_at
-            FROM uploaded_pdfs
-            WHERE user_id = %s
-            ORDER BY uploaded_at DESC
-        """, (user_id,))
-    else:
-        cursor.execute("""
-            SELECT id, filename, pdf_text, pages, chunks, summary, uploaded_at
-            FROM uploaded_pdfs
-            WHERE user_id = ?
-            ORDER BY uploaded_at DESC
-        """, (user_id,))
+    return {row['pdf_id']: row['pdf_text'] for row in rows}
+
+async def get_bm25_blobs(pdf_ids: List[int]) -> Dict[int, Optional[bytes]]:
+    """Get the stored keyword indexes of the given PDFs, keyed by PDF ID"""
+    if not pdf_ids:
+        return {}
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            rows = await conn.fetch("""
+                SELECT id, bm25_blob FROM uploaded_pdfs WHERE id = ANY($1::int[])
+            """, pdf_ids)
+        else:
+            placeholders = ", ".join("?" * len(pdf_ids))
+            cursor = await conn.execute(f"""
+                SELECT id, bm25_blob FROM uploaded_pdfs WHERE id IN ({placeholders})
+            """, pdf_ids)
+            rows = await cursor.fetchall()
     
-    rows = cursor.fetchall()
-    conn.close()
+    return {row['id']: row['bm25_blob'] for row in rows}
+
+async def get_pdf_chunks(pdf_ids: List[int]) -> Dict[int, List[Dict]]:
+    """Get the stored retrieval chunks of the given PDFs, in order, keyed by PDF ID"""
+    if not pdf_ids:
+        return {}
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            rows = await conn.fetch("""
+                SELECT pdf_id, page, chunk_text
+                FROM pdf_chunks
+                WHERE pdf_id = ANY($1::int[])
+                ORDER BY pdf_id, idx
+            """, pdf_ids)
+        else:
+            placeholders = ", ".join("?" * len(pdf_ids))
+            cursor = await conn.execute(f"""
+                SELECT pdf_id, page, chunk_text
+                FROM pdf_chunks
+                WHERE pdf_id IN ({placeholders})
+                ORDER BY pdf_id, idx
+            """, pdf_ids)
+            rows = await cursor.fetchall()
     
-    return [dict(row) for row in rows]
+    chunks = {}
+    for row in rows:
+        chunks.setdefault(row['pdf_id'], []).append({"text": row['chunk_text'], "page": row['page']})
+    return chunks
 
-def get_pdf_by_id(pdf_id: int) -> Optional[Dict]:
+async def get_pdf_by_id(pdf_id: int) -> Optional[Dict]:
     """Get a specific PDF by ID"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("SELECT * FROM uploaded_pdfs WHERE id = %s", (pdf_id,))
-    else:
-        cursor.execute("SELECT * FROM uploaded_pdfs WHERE id = ?", (pdf_id,))
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            row = await conn.fetchrow("SELECT * FROM uploaded_pdfs WHERE id = $1", pdf_id)
+        else:
+            cursor = await conn.execute("SELECT * FROM uploaded_pdfs WHERE id = ?", (pdf_id,))
+            row = await cursor.fetchone()
     
-    row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
-def delete_pdf(pdf_id: int):
+async def delete_pdf(pdf_id: int):
     """Delete a PDF"""
-    conn = get_db()
-    cursor = conn.cursor()
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            await conn.execute("DELETE FROM uploaded_pdfs WHERE id = $1", pdf_id)
+        else:
+            # SQLite doesn't enforce ON DELETE CASCADE without PRAGMA foreign_keys
+            await conn.execute("DELETE FROM pdf_chunks WHERE pdf_id = ?", (pdf_id,))
+            await conn.execute("DELETE FROM uploaded_pdf_texts WHERE pdf_id = ?", (pdf_id,))
+            await conn.execute("DELETE FROM uploaded_pdfs WHERE id = ?", (pdf_id,))
+            await conn.commit()
+
+async def clear_chat_and_pdfs(user_id: int):
+    """Delete a user's chat history and all their PDFs in one transaction"""
+    await flush_chat_messages()
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM chat_history WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM uploaded_pdfs WHERE user_id = $1", user_id)
+        else:
+            await conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            for table in ("pdf_chunks", "uploaded_pdf_texts"):
+                await conn.execute(f"""
+                    DELETE FROM {table}
+                    WHERE pdf_id IN (SELECT id FROM uploaded_pdfs WHERE user_id = ?)
+                """, (user_id,))
+            await conn.execute("DELETE FROM uploaded_pdfs WHERE user_id = ?", (user_id,))
+            await conn.commit()
+
+# === VECTOR SEARCH (PostgreSQL + pgvector only) ===
+
+async def add_chunk_embeddings(pdf_id: int, chunks: List[Dict], embeddings: List[List[float]]):
+    """Store embedded chunks of a PDF in a single transaction"""
+    async with get_db() as conn:
+        await conn.executemany("""
+            INSERT INTO chunk_embeddings (pdf_id, page, chunk_text, embedding)
+            VALUES ($1, $2, $3, $4::float4[]::vector)
+        """, [
+            (pdf_id, chunk['page'], chunk['text'], embedding)
+            for chunk, embedding in zip(chunks, embeddings)
+        ])
+
+async def search_chunk_embeddings(pdf_ids: List[int], query_embedding: List[float],
+                                  limit: int = 8) -> List[Dict]:
+    """Exact nearest-neighbour chunk lookup across the given PDFs (cosine distance)"""
+    async with get_db() as conn:
+        rows = await conn.fetch("""
+            SELECT ce.chunk_text AS text, ce.page, p.filename AS source
+            FROM chunk_embeddings ce
+            JOIN uploaded_pdfs p ON p.id = ce.pdf_id
+            WHERE ce.pdf_id = ANY($1::int[])
+            ORDER BY ce.embedding <=> $2::float4[]::vector
+            LIMIT $3
+        """, pdf_ids, query_embedding, limit)
     
-    if USE_POSTGRES:
-        cursor.execute("DELETE FROM uploaded_pdfs WHERE id = %s", (pdf_id,))
-    else:
-        cursor.execute("DELETE FROM uploaded_pdfs WHERE id = ?", (pdf_id,))
+    return [dict(row) for row in rows]
+
+async def get_embedded_pdf_ids(pdf_ids: List[int]) -> List[int]:
+    """Which of the given PDFs have chunk embeddings"""
+    async with get_db() as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT pdf_id FROM chunk_embeddings WHERE pdf_id = ANY($1::int[])
+        """, pdf_ids)
     
-    conn.commit()
-    conn.close()
+    return [row['pdf_id'] for row in rows]
+
+# === LLM RESPONSE CACHE ===
+
+async def get_llm_cache(key: str, max_age: int) -> Optional[str]:
+    """Cached LLM response for key, if written within the last max_age seconds"""
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            return await conn.fetchval("""
+                SELECT response FROM llm_cache
+                WHERE key = $1 AND created_at > CURRENT_TIMESTAMP - make_interval(secs => $2::int)
+            """, key, max_age)
+        else:
+            cursor = await conn.execute("""
+                SELECT response FROM llm_cache
+                WHERE key = ? AND created_at > datetime('now', ?)
+            """, (key, f"-{max_age} seconds"))
+            row = await cursor.fetchone()
+            return row['response'] if row else None
+
+async def set_llm_cache(key: str, response: str):
+    """Store (or refresh) a cached LLM response"""
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            await conn.execute("""
+                INSERT INTO llm_cache (key, response) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, created_at = CURRENT_TIMESTAMP
+            """, key, response)
+        else:
+            await conn.execute("""
+                INSERT INTO llm_cache (key, response) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET response = excluded.response, created_at = CURRENT_TIMESTAMP
+            """, (key, response))
+            await conn.commit()
+
+async def prune_llm_cache(max_age: int, prefix: str = ""):
+    """Drop cached LLM responses under a key prefix older than max_age seconds"""
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            await conn.execute("""
+                DELETE FROM llm_cache
+                WHERE key LIKE $2 || '%' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => $1::int)
+            """, max_age, prefix)
+        else:
+            await conn.execute("""
+                DELETE FROM llm_cache
+                WHERE key LIKE ? || '%' AND created_at < datetime('now', ?)
+            """, (prefix, f"-{max_age} seconds"))
+            await conn.commit()
 
 # === STATISTICS ===
 
-def get_user_stats(user_id: int) -> Dict:
-    """Get user statistics"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute("SELECT COUNT(*) as count FROM uploaded_pdfs WHERE user_id = %s", (user_id,))
-        pdf_count = cursor.fetchone()['count']
-        
-        cursor.execute("SELECT COUNT(*) as count FROM chat_history WHERE user_id = %s", (user_id,))
-        message_count = cursor.fetchone()['count']
-    else:
-        cursor.execute("SELECT COUNT(*) FROM uploaded_pdfs WHERE user_id = ?", (user_id,))
-        pdf_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM chat_history WHERE user_id = ?", (user_id,))
-        message_count = cursor.fetchone()[0]
-    
-    conn.close()
+async def get_user_stats(user_id: int) -> Dict:
+    """Get user statistics (one round-trip)"""
+    await flush_chat_messages()
+    async with get_db() as conn:
+        if USE_POSTGRES:
+            row = await conn.fetchrow("""
+                SELECT (SELECT COUNT(*) FROM uploaded_pdfs WHERE user_id = $1) AS pdf_count,
+                       (SELECT COUNT(*) FROM chat_history WHERE user_id = $1) AS message_count
+            """, user_id)
+        else:
+            cursor = await conn.execute("""
+                SELECT (SELECT COUNT(*) FROM uploaded_pdfs WHERE user_id = ?) AS pdf_count,
+                       (SELECT COUNT(*) FROM chat_history WHERE user_id = ?) AS message_count
+            """, (user_id, user_id))
+            row = await cursor.fetchone()
     
     return {
-        "pdfs_uploaded": pdf_count,
-        "messages_sent": message_count
+        "pdfs_uploaded": row['pdf_count'],
+        "messages_sent": row['message_count']
     }
@@ -1,29 +1,42 @@
 # ingest.py - PDF ingestion (stores text in database, no file storage)
 import os
 from pypdf import PdfReader
-from llm_agent import summarize_document
+from chunking import split_into_chunks, build_bm25_blob
 import io
 
-def ingest_pdf_to_text(upload_file) -> tuple:
+# PyMuPDF is optional: it is a C extension several times faster than pypdf
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+def extract_page_texts(pdf_bytes: bytes) -> list:
+    """Text of each page, via PyMuPDF when installed, else pypdf"""
+    if pymupdf is not None:
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [page.get_text() for page in doc]
+    
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [page.extract_text() or "" for page in reader.pages]
+
+def ingest_pdf_bytes(filename: str, pdf_bytes: bytes) -> tuple:
     """
-    Process a PDF file and extract text (no file storage needed).
+    Process raw PDF bytes and extract text (no file storage needed).
+    Takes plain bytes so it can run in a worker process. The summary is generated by
+    the caller, which can check the database cache first.
     
     Returns:
-        (pdf_text, pages_count, summary, pdf_name)
+        (pdf_text, pages_count, pdf_name, chunks, bm25_blob)
     """
-    pdf_name = os.path.splitext(upload_file.filename)[0]
+    pdf_name = os.path.splitext(filename)[0].replace('\x00', '')
     
     print(f"📄 Processing {pdf_name}...")
     
     try:
-        # Read PDF directly from upload without saving to disk
-        pdf_bytes = upload_file.file.read()
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        
-        # Extract text from all pages
+        # Extract text from all pages directly from the upload, without saving to disk
         pages_text = []
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text() or ""
+        for i, text in enumerate(extract_page_texts(pdf_bytes)):
+            text = text.replace('\x00', '')  # PostgreSQL TEXT can't store NUL
             if text.strip():
                 pages_text.append(f"--- Page {i+1} ---\n{text}")
         
@@ -36,18 +49,13 @@ def ingest_pdf_to_text(upload_file) -> tuple:
         
         print(f"✅ Extracted text from {pages_count} pages")
         
-        # Generate summary
-        print(f"🔄 Generating summary...")
-        try:
-            doc_summary = summarize_document(full_text)
-            print(f"✅ Summary: {doc_summary[:100]}...")
-        except Exception as e:
-            print(f"❌ Error generating summary: {e}")
-            doc_summary = f"Document: {pdf_name}. {pages_text[0][:300]}..."
+        # Chunk and pre-tokenize once so queries don't re-split the PDF
+        chunks = split_into_chunks(full_text, pdf_name)
+        bm25_blob = build_bm25_blob(chunks)
         
         print(f"✅ Processed {pdf_name}: {pages_count} pages")
         
-        return full_text, pages_count, doc_summary, pdf_name
+        return full_text, pages_count, pdf_name, chunks, bm25_blob
         
     except Exception as e:
         print(f"❌ Error processing PDF: {e}")
@@ -3,6 +3,40 @@ import os
 from langchain_groq import ChatGroq
 
 MODEL = "llama-3.1-8b-instant"
+EMBEDDING_MODEL = "models/text-embedding-004"  # 768-dim, see database.EMBEDDING_DIM
+
+# Embeddings are optional (Groq has no embedding API); enabled by GOOGLE_API_KEY
+USE_EMBEDDINGS = os.getenv("GOOGLE_API_KEY") is not None
+
+if USE_EMBEDDINGS:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+# Context budgets in tokens; tiktoken is optional, otherwise ~4 chars per token
+MAX_CHUNK_TOKENS = 400
+MAX_CONTEXT_TOKENS = 3500
+
+try:
+    import tiktoken
+    _encoder = tiktoken.get_encoding("cl100k_base")
+except Exception:  # not installed, or the encoding file can't be fetched
+    _encoder = None
+
+def count_tokens(text: str) -> int:
+    """Approximate token count of text"""
+    if _encoder is not None:
+        return len(_encoder.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens, marking the cut with an ellipsis"""
+    if _encoder is not None:
+        tokens = _encoder.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return _encoder.decode(tokens[:max_tokens]) + "..."
+    if len(text) <= max_tokens * 4:
+        return text
+    return text[:max_tokens * 4] + "..."
 
 def get_llm():
     """Get LLM instance"""
@@ -12,17 +46,22 @@ def get_llm():
         temperature=0.1
     )
 
-def answer_with_context(question: str, chunks: list) -> str:
+def get_embeddings():
+    """Get embedding model instance (None if embeddings are not configured)"""
+    if not USE_EMBEDDINGS:
+        return None
+    return GoogleGenerativeAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        google_api_key=os.getenv("GOOGLE_API_KEY")
+    )
+
+def build_answer_prompt(question: str, chunks: list) -> str:
     """
-    Answer question using context from multiple PDFs.
-    Returns answer with inline citations.
+    Build the question-answering prompt from retrieved chunks.
     """
-    llm = get_llm()
-    
     # Build context from chunks (limit to prevent token overflow)
     context_parts = []
-    total_chars = 0
-    max_context_chars = 12000  # Safe limit to avoid token issues
+    total_tokens = 0
     
     for i, chunk in enumerate(chunks[:6], 1):  # Max 6 chunks
         if isinstance(chunk, dict):
@@ -35,17 +74,17 @@ def answer_with_context(question: str, chunks: list) -> str:
             page = 'N/A'
         
         # Truncate text if needed
-        if len(text) > 1500:
-            text = text[:1500] + "..."
+        text = truncate_tokens(text, MAX_CHUNK_TOKENS)
         
         chunk_text = f"[Source {i}: {source}, Page {page}]\n{text}\n"
+        chunk_tokens = count_tokens(chunk_text)
         
         # Check if adding this chunk would exceed limit
-        if total_chars + len(chunk_text) > max_context_chars:
+        if total_tokens + chunk_tokens > MAX_CONTEXT_TOKENS:
             break
         
         context_parts.append(chunk_text)
-        total_chars += len(chunk_text)
+        total_tokens += chunk_tokens
     
     context_text = "\n".join(context_parts)
     
@@ -64,7 +103,16 @@ INSTRUCTIONS:
 5. Be precise and academic in your tone
 
 ANSWER:"""
+    return prompt
 
+def answer_with_context(question: str, chunks: list) -> str:
+    """
+    Answer question using context from multiple PDFs.
+    Returns answer with inline citations.
+    """
+    llm = get_llm()
+    prompt = build_answer_prompt(question, chunks)
+    
     try:
         response = llm.invoke(prompt)
         return response.content
@@ -72,6 +120,18 @@ ANSWER:"""
         print(f"Error generating response: {e}")
         return f"I apologize, but I encountered an error while processing your question. This might be due to the document size. Try asking a more specific question or upload fewer documents."
 
+async def answer_with_context_stream(question: str, chunks: list):
+    """
+    Streaming variant of answer_with_context.
+    Yields answer text as the LLM emits it; errors propagate to the caller.
+    """
+    llm = get_llm()
+    prompt = build_answer_prompt(question, chunks)
+    
+    async for chunk in llm.astream(prompt):
+        if chunk.content:
+            yield chunk.content
+
 def summarize_document(full_text: str) -> str:
     """
     Generate a concise summary of a research document.
@@ -101,12 +161,10 @@ DOCUMENT TEXT:
 {text_to_summarize}
 
 SUMMARY (3-4 sentences only):"""
-
-    try:
-        response = llm.invoke(prompt)
-        return response.content.strip()
-    except Exception as e:
-        return f"Summary generation failed: {str(e)}"
+    
+    # Errors propagate so callers can fall back without caching a failure
+    response = llm.invoke(prompt)
+    return response.content.strip()
 
 def extract_citations_from_response(response_text: str) -> str:
     """
@@ -1,26 +1,29 @@
 # paper_search.py - Extract references and generate related papers
 import re
+import html
 from llm_agent import get_llm
 
+# Compiled once; IGNORECASE finds the section heading without lowercasing the whole text
+_REF_SECTION_RES = [
+    re.compile(r'(?:references|bibliography|works cited)\s*\n(.*?)(?:\n\n\n|\Z)', re.DOTALL | re.IGNORECASE),
+    re.compile(r'(?:references|bibliography)\s*\n(.*?)(?:appendix|\Z)', re.DOTALL | re.IGNORECASE),
+]
+_REF_LINE_RE = re.compile(r'([A-Z][^.]+\.\s*\(\d{4}\)[^.]+\.)')
+
 def extract_references_from_text(pdf_text: str) -> list:
     """
     Extract references/bibliography from PDF text.
     """
     try:
         # Look for references section
-        ref_patterns = [
-            r'(?:references|bibliography|works cited)\s*\n(.*?)(?:\n\n\n|\Z)',
-            r'(?:references|bibliography)\s*\n(.*?)(?:appendix|\Z)',
-        ]
-        
         references = []
-        for pattern in ref_patterns:
-            match = re.search(pattern, pdf_text.lower(), re.DOTALL | re.IGNORECASE)
+        for pattern in _REF_SECTION_RES:
+            match = pattern.search(pdf_text)
             if match:
                 ref_text = match.group(1)
                 
                 # Extract individual references
-                ref_lines = re.findall(r'([A-Z][^.]+\.\s*\(\d{4}\)[^.]+\.)', ref_text)
+                ref_lines = _REF_LINE_RE.findall(ref_text)
                 references.extend(ref_lines[:10])  # Limit to 10
                 break
         
@@ -85,7 +88,7 @@ def search_papers_from_pdf(pdfs: list, response_text: str) -> str:
         html_output += "<p style='color: #a78bfa; font-weight: 600; margin: 0 0 10px 0;'>📚 References from Paper:</p>"
         html_output += "<ul style='margin: 0 0 15px 0; padding-left: 20px;'>"
         for i, ref in enumerate(all_references[:5], 1):  # Show max 5 references
-            html_output += f"<li style='margin: 5px 0; color: #d1d5db;'>{ref}</li>"
+            html_output += f"<li style='margin: 5px 0; color: #d1d5db;'>{html.escape(ref)}</li>"
         html_output += "</ul>"
     
     # 2. Generate related papers using LLM
@@ -1,101 +1,237 @@
 # retrieval.py - Retrieve from PDF texts stored in database
-from typing import List, Dict
+from itertools import zip_longest
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+from cachetools import LRUCache
+import database
+from chunking import split_into_chunks, tokenize, build_bm25_index, load_bm25_blob
+from llm_agent import get_embeddings
 
-def extract_chunks_from_text(pdf_text: str, filename: str) -> List[Dict]:
+# Numba is optional: without it BM25 scoring uses the vectorized NumPy version
+try:
+    from numba import njit
+    USE_NUMBA = True
+except ImportError:
+    USE_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+embeddings = get_embeddings()  # None when vector search is not configured
+_index_cache = LRUCache(maxsize=64)  # pdf_id -> (chunks, BM25 index)
+_embedded_pdfs = LRUCache(maxsize=4096)  # pdf_id -> True once known to have embeddings
+
+def vector_search_enabled() -> bool:
+    """Vector search needs both an embedding model and pgvector"""
+    return embeddings is not None and database.USE_PGVECTOR
+
+async def index_pdf_chunks(pdf_id: int, chunks: List[Dict], filename: str):
     """
-    Split PDF text into chunks by pages.
+    Store embeddings of a PDF's chunks for vector search.
+    All chunks are embedded in one batched call.
     """
-    chunks = []
-    pdf_text = pdf_text.replace('\x00', '')
-    # Split by page markers
-    pages = pdf_text.split("--- Page ")
-    
-    for page_text in pages:
-        if not page_text.strip():
-            continue
-        
-        # Extract page number
-        try:
-            page_num_end = page_text.find(" ---")
-            if page_num_end > 0:
-                page_num = page_text[:page_num_end].strip()
-                text = page_text[page_num_end + 4:].strip()
-            else:
-                page_num = "1"
-                text = page_text.strip()
-        except:
-            page_num = "?"
-            text = page_text.strip()
-        
-        if text:
-            chunks.append({
-                "text": text,
-                "page": page_num,
-                "source": filename
-            })
-    
-    return chunks
+    if not vector_search_enabled() or not chunks:
+        return
+    
+    try:
+        vectors = await embeddings.aembed_documents([chunk['text'] for chunk in chunks])
+        await database.add_chunk_embeddings(pdf_id, chunks, vectors)
+        print(f"✅ Indexed {len(chunks)} chunks for {filename}")
+    except Exception as e:
+        # The PDF stays usable through keyword search
+        print(f"❌ Error indexing {filename}: {e}")
 
-def simple_keyword_search(query: str, chunks: List[Dict], top_k: int = 5) -> List[Dict]:
+def gather_postings(indexes: List[Dict[str, np.ndarray]], query_ids: np.ndarray):
     """
-    Simple keyword-based search to find relevant chunks.
+    Collect the postings of the query terms across several PDF indexes.
+    Chunk numbers are shifted so they index into the concatenated chunk list.
+    Returns (post_terms, post_docs, post_tf, doc_lens).
     """
-    query_lower = query.lower()
-    query_words = set(query_lower.split())
-    
-    # Score each chunk based on keyword overlap
-    scored_chunks = []
-    for chunk in chunks:
-        text_lower = chunk['text'].lower()
-        text_words = set(text_lower.split())
-        
-        # Calculate overlap score
-        overlap = len(query_words & text_words)
-        
-        # Bonus for exact phrase match
-        if query_lower in text_lower:
-            overlap += 10
-        
-        if overlap > 0:
-            scored_chunks.append((overlap, chunk))
+    term_parts, doc_parts, tf_parts = [], [], []
+    doc_base = 0
+    for index in indexes:
+        vocab = index['vocab']
+        if len(vocab):
+            pos = np.minimum(np.searchsorted(vocab, query_ids), len(vocab) - 1)
+            post_offsets = index['post_offsets']
+            for j in np.flatnonzero(vocab[pos] == query_ids):
+                start, end = post_offsets[pos[j]], post_offsets[pos[j] + 1]
+                term_parts.append(np.full(end - start, j, dtype=np.int64))
+                doc_parts.append(index['post_docs'][start:end].astype(np.int64) + doc_base)
+                tf_parts.append(index['post_tf'][start:end].astype(np.float64))
+        doc_base += len(index['doc_lens'])
+    
+    if not term_parts:
+        term_parts = doc_parts = [np.zeros(0, dtype=np.int64)]
+        tf_parts = [np.zeros(0, dtype=np.float64)]
+    doc_lens = np.concatenate([index['doc_lens'] for index in indexes]).astype(np.float64)
+    return np.concatenate(term_parts), np.concatenate(doc_parts), np.concatenate(tf_parts), doc_lens
+
+@njit(cache=True)
+def _bm25_scores(post_terms, post_docs, post_tf, doc_lens, n_terms, k1, b):
+    """BM25 score of every chunk from the postings of the (unique) query terms."""
+    n_docs = doc_lens.shape[0]
+    scores = np.zeros(n_docs, dtype=np.float64)
+    if n_docs == 0 or n_terms == 0:
+        return scores
+    
+    # Document frequencies: one posting per (term, chunk) pair
+    df = np.zeros(n_terms, dtype=np.float64)
+    for i in range(post_terms.shape[0]):
+        df[post_terms[i]] += 1.0
+    idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+    
+    avgdl = max(doc_lens.sum() / n_docs, 1.0)
+    for i in range(post_terms.shape[0]):
+        d = post_docs[i]
+        f = post_tf[i]
+        norm = k1 * (1.0 - b + b * doc_lens[d] / avgdl)
+        scores[d] += idf[post_terms[i]] * f * (k1 + 1.0) / (f + norm)
+    return scores
+
+def _bm25_scores_numpy(post_terms, post_docs, post_tf, doc_lens, n_terms, k1, b):
+    """Same scores as _bm25_scores, as whole-array NumPy operations."""
+    n_docs = doc_lens.shape[0]
+    if n_docs == 0 or n_terms == 0:
+        return np.zeros(n_docs, dtype=np.float64)
+    
+    df = np.bincount(post_terms, minlength=n_terms).astype(np.float64)
+    idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+    avgdl = max(doc_lens.sum() / n_docs, 1.0)
+    norm = k1 * (1.0 - b + b * doc_lens[post_docs] / avgdl)
+    contrib = idf[post_terms] * post_tf * (k1 + 1.0) / (post_tf + norm)
+    return np.bincount(post_docs, weights=contrib, minlength=n_docs)
+
+def bm25_search(query: str, chunks: List[Dict], indexes: List[Dict[str, np.ndarray]],
+                top_k: int = 5) -> List[Dict]:
+    """
+    Rank chunks against the query with BM25 and return the top_k matches.
+    `indexes` are the per-PDF indexes, in the same order as `chunks`.
+    """
+    if not chunks:
+        return []
     
-    # Sort by score and return top_k
-    scored_chunks.sort(reverse=True, key=lambda x: x[0])
-    return [chunk for _, chunk in scored_chunks[:top_k]]
+    query_ids = np.unique(tokenize(query))
+    post_terms, post_docs, post_tf, doc_lens = gather_postings(indexes, query_ids)
+    score = _bm25_scores if USE_NUMBA else _bm25_scores_numpy
+    scores = score(post_terms, post_docs, post_tf, doc_lens, len(query_ids), BM25_K1, BM25_B)
+    
+    # Partial sort: only the top_k candidates get fully ordered
+    k = min(top_k, len(scores))
+    if k == 0:
+        return []
+    top = np.argpartition(scores, -k)[-k:]
+    top = top[np.argsort(scores[top])[::-1]]
+    return [chunks[i] for i in top if scores[i] > 0]
+
+def warm_up_bm25():
+    """Compile (or load) the Numba kernel now, not on the event loop at the first query"""
+    chunks = [{"text": "warm up", "page": "1", "source": ""}]
+    bm25_search("warm", chunks, [build_bm25_index(chunks)], 1)
 
-def retrieve_from_pdf_texts(query: str, pdfs: List[Dict], top_k: int = 6) -> List[Dict]:
+async def load_keyword_indexes(pdfs: List[Dict]) -> List[Tuple[List[Dict], Dict[str, np.ndarray]]]:
+    """
+    (chunks, BM25 index) for each PDF, from the per-process cache or the database.
+    PDFs never change after upload and IDs are never reused, so entries stay valid.
+    """
+    missing = [pdf for pdf in pdfs if pdf['id'] not in _index_cache]
+    if missing:
+        ids = [pdf['id'] for pdf in missing]
+        stored_chunks = await database.get_pdf_chunks(ids)
+        blobs = await database.get_bm25_blobs(list(stored_chunks))
+        # PDFs uploaded before chunks were stored are split from their full text
+        texts = await database.get_pdf_texts([pdf_id for pdf_id in ids if pdf_id not in stored_chunks])
+        for pdf in missing:
+            chunks = stored_chunks.get(pdf['id'])
+            if chunks:
+                for chunk in chunks:
+                    chunk['source'] = pdf['filename']
+                index = load_bm25_blob(blobs.get(pdf['id'])) or build_bm25_index(chunks)
+            elif texts.get(pdf['id']):
+                chunks = split_into_chunks(texts[pdf['id']], pdf['filename'])
+                index = build_bm25_index(chunks)
+            else:
+                continue
+            _index_cache[pdf['id']] = (chunks, index)
+    
+    return [_index_cache[pdf['id']] for pdf in pdfs if pdf['id'] in _index_cache]
+
+async def retrieve_from_pdf_texts(query: str, pdfs: List[Dict], top_k: int = 6,
+                                  query_vector: Optional[List[float]] = None) -> List[Dict]:
     """
     Retrieve relevant chunks from multiple PDFs stored in database.
+    Uses vector search when available, keyword search otherwise.
     
     Args:
         query: User's question
-        pdfs: List of PDF records from database (contains pdf_text field)
+        pdfs: List of PDF records from database
         top_k: Number of chunks to return
+        query_vector: Query embedding, if the caller already computed one
     
     Returns:
         List of relevant text chunks with metadata
     """
+    vector_chunks = []
+    if vector_search_enabled():
+        embedded = await embedded_pdf_ids(pdfs)
+        if embedded:
+            if query_vector is None:
+                query_vector = await embeddings.aembed_query(query)
+            vector_chunks = await database.search_chunk_embeddings(embedded, query_vector, top_k)
+        
+        # PDFs uploaded before vector search was enabled, or whose indexing failed,
+        # have no embeddings: search those by keyword and merge the results
+        pdfs = [pdf for pdf in pdfs if pdf['id'] not in embedded]
+        if not pdfs and vector_chunks:
+            return vector_chunks
+    
+    keyword_chunks = await keyword_search_pdfs(query, pdfs, top_k, fill=not vector_chunks)
+    if vector_chunks:
+        # Scores aren't comparable across the two searches: alternate their rankings
+        merged = [chunk for pair in zip_longest(vector_chunks, keyword_chunks)
+                  for chunk in pair if chunk is not None]
+        return merged[:top_k]
+    
+    return keyword_chunks or [{
+        "text": "No document content available.",
+        "page": "0",
+        "source": "System"
+    }]
+
+async def embedded_pdf_ids(pdfs: List[Dict]) -> List[int]:
+    """IDs of the given PDFs that have chunk embeddings (positives are cached: PDFs never change)"""
+    unknown = [pdf['id'] for pdf in pdfs if pdf['id'] not in _embedded_pdfs]
+    if unknown:
+        for pdf_id in await database.get_embedded_pdf_ids(unknown):
+            _embedded_pdfs[pdf_id] = True
+    return [pdf['id'] for pdf in pdfs if pdf['id'] in _embedded_pdfs]
+
+async def keyword_search_pdfs(query: str, pdfs: List[Dict], top_k: int,
+                              fill: bool = True) -> List[Dict]:
+    """
+    BM25 search over the chunks stored for the given PDFs ([] when they have none).
+    With fill, a query matching no terms returns the first chunks instead.
+    """
     all_chunks = []
+    indexes = []
     
-    # Extract chunks from all PDFs (limit to first 3 PDFs to avoid token issues)
-    for pdf in pdfs[:3]:  # LIMIT TO 3 PDFs MAX
-        if pdf.get('pdf_text'):
-            chunks = extract_chunks_from_text(pdf['pdf_text'], pdf['filename'])
-            all_chunks.extend(chunks)
+    # Search the chunks stored at upload (limit to first 3 PDFs to avoid token issues)
+    for chunks, index in await load_keyword_indexes(pdfs[:3]):  # LIMIT TO 3 PDFs MAX
+        all_chunks.extend(chunks)
+        indexes.append(index)
     
     if not all_chunks:
-        return [{
-            "text": "No document content available.",
-            "page": "0",
-            "source": "System"
-        }]
+        return []
     
     # Retrieve most relevant chunks
-    relevant_chunks = simple_keyword_search(query, all_chunks, top_k)
+    relevant_chunks = bm25_search(query, all_chunks, indexes, top_k)
     
     # If no relevant chunks found, return first few chunks as fallback
-    if not relevant_chunks:
+    if not relevant_chunks and fill:
         relevant_chunks = all_chunks[:top_k]
+    relevant_chunks = [dict(chunk) for chunk in relevant_chunks]  # cached chunks stay untouched
     
     # Truncate each chunk to max 1000 chars to avoid token limits
     for chunk in relevant_chunks:
@@ -0,0 +1,64 @@
+# semantic_cache.py - Reuse answers to near-identical questions about the same PDFs
+from typing import List, Optional
+import numpy as np
+from cachetools import LRUCache
+from llm_agent import get_embeddings
+
+# Google embeddings score paraphrases high; stay strict so distinct questions miss
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES_PER_SCOPE = 50
+MAX_CACHE_BYTES = 32 * 1024 * 1024  # vectors and answers across all users, per process
+
+embeddings = get_embeddings()  # None when embeddings are not configured
+
+def _entry_size(entry) -> int:
+    _, matrix, answers = entry
+    return matrix.nbytes + sum(len(answer) for answer in answers)
+
+# user_id -> (scope, unit question vectors, cached answers). Only the user's current
+# scope (PDF set + version) is kept, so a version bump strands nothing.
+_users = LRUCache(maxsize=MAX_CACHE_BYTES, getsizeof=_entry_size)
+
+async def embed_question(question: str) -> Optional[List[float]]:
+    """Embed a question for lookup (None when embeddings are not configured)"""
+    if embeddings is None:
+        return None
+    return await embeddings.aembed_query(question)
+
+def _unit(vector: List[float]) -> np.ndarray:
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def semantic_lookup(user_id: int, scope: str, vector: Optional[List[float]]) -> Optional[str]:
+    """Cached answer of the most similar earlier question in this scope, if close enough"""
+    entry = _users.get(user_id)
+    if entry is None or entry[0] != scope or vector is None:
+        return None
+    
+    _, matrix, answers = entry
+    similarities = matrix @ _unit(vector)
+    best = int(np.argmax(similarities))
+    return answers[best] if similarities[best] >= SIMILARITY_THRESHOLD else None
+
+def semantic_store(user_id: int, scope: str, vector: Optional[List[float]], answer: str):
+    """Remember an answer; each user keeps the most recent questions of one scope only"""
+    if vector is None:
+        return
+    
+    entry = _users.get(user_id)
+    if entry is None or entry[0] != scope:
+        entry = (scope, np.zeros((0, len(vector)), dtype=np.float32), [])
+    _, matrix, answers = entry
+    try:
+        _users[user_id] = (
+            scope,
+            np.vstack([matrix, _unit(vector)])[-MAX_ENTRIES_PER_SCOPE:],
+            (answers + [answer])[-MAX_ENTRIES_PER_SCOPE:]
+        )
+    except ValueError:
+        pass  # larger than the whole cache
+
+def semantic_forget(user_id: int):
+    """Drop a user's cached answers (their PDF set changed)"""
+    _users.pop(user_id, None)
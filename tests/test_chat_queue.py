@@ -0,0 +1,72 @@
+# test_chat_queue.py - Batched chat history writes on the SQLite backend
+import os
+import json
+import asyncio
+import pytest
+
+os.environ.pop("DATABASE_URL", None)
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh SQLite database, journal directory and queue for each test"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "_pending_messages", database.deque())
+    monkeypatch.setattr(database, "_flush_lock", asyncio.Lock())
+    monkeypatch.setattr(database, "sqlite_lock", asyncio.Lock())
+    return tmp_path
+
+async def _start():
+    await database.init_db()
+    async with database.get_db() as conn:
+        await conn.execute("""
+            INSERT INTO users (google_id, email, name, username, organization)
+            VALUES ('g1', 'a@x.org', 'A', 'a', 'O')
+        """)
+        await conn.commit()
+
+def _write_journal(path, rows, tail=""):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(row) + "\n" for row in rows)
+        f.write(tail)
+
+def test_orphaned_journal_is_adopted(db):
+    # A dead worker's journal, its last line cut short by the crash
+    _write_journal("chat_journal.999999.jsonl", [[1, "user", "orphaned", ""]], tail='[1, "assis')
+    # A live worker's journal: its lock is held
+    _write_journal("chat_journal.888888.jsonl", [[1, "user", "live", ""]])
+    live_lock = database._try_lock("chat_journal.888888.lock")
+    
+    async def scenario():
+        await _start()
+        history = await database.get_chat_history(1)
+        await database.close_db()
+        return history
+    
+    try:
+        history = asyncio.run(scenario())
+    finally:
+        database._release_lock(live_lock, "chat_journal.888888.lock")
+    
+    assert [m['content'] for m in history] == ["orphaned"]
+    assert not os.path.exists("chat_journal.999999.jsonl")
+    assert os.path.exists("chat_journal.888888.jsonl")
+
+def test_bad_row_does_not_block_queue(db):
+    async def scenario():
+        await _start()
+        await database.add_chat_messages([
+            (1, "user", "question\x00", ""),
+            (1, "assistant", "answer", "")
+        ])
+        database._pending_messages.append((1, "user", {"not": "text"}, ""))  # unbindable
+        await database.add_chat_message(1, "user", "after")
+        history = await database.get_chat_history(1)
+        pending = list(database._pending_messages)
+        await database.close_db()
+        return history, pending
+    
+    history, pending = asyncio.run(scenario())
+    assert [m['content'] for m in history] == ["question", "answer", "after"]
+    assert pending == []
+    assert not os.path.exists(database.CHAT_JOURNAL)